@@ -0,0 +1,529 @@
+import os
+import json
+import mmap
+import time
+import base64
+import shutil
+import struct
+import tempfile
+import numpy as np
+
+# streaming readers for the processed map jsons, no bpy so they can be used outside of Blender
+# comps are decoded one at a time, instanceData and vertex colours are left in the file until the actor using them is built
+
+CHUNK_SIZE = 1024 * 1024
+INSTANCE_DATA_INDEX = 10
+VERTEX_COLOR_INDEX = 11
+LAZY_FIELDS = (INSTANCE_DATA_INDEX, VERTEX_COLOR_INDEX)
+EMPTY_JSON = (b"", b"null", b"[]", b"{}", b'""')
+
+QUOTE = ord('"')
+BACKSLASH = ord('\\')
+STRUCTURAL = np.zeros(256, dtype=bool)
+STRUCTURAL[list(b"[]{},")] = True
+DEPTH_CHANGE = np.zeros(256, dtype=np.int32)
+DEPTH_CHANGE[list(b"[{")] = 1
+DEPTH_CHANGE[list(b"]}")] = -1
+
+
+class LazyJSON:
+    # a JSON value kept as its text and decoded on first use
+    __slots__ = ("text", "value")
+
+    def __init__(self, text: bytes):
+        self.text = text
+        self.value = None
+
+    def get(self):
+        if self.value is None:
+            self.value = json.loads(self.text)
+        return self.value
+
+    def __bool__(self):
+        # empty or null without decoding
+        return self.text.strip() not in EMPTY_JSON
+
+    def __len__(self):
+        return len(self.get()) if self else 0
+
+    def __iter__(self):
+        return iter(self.get() or ())
+
+    def __getitem__(self, key):
+        return self.get()[key]
+
+
+def scan_structure(buffer: bytes, depth: int):
+    # positions, characters and depth after each of [ ] { } , outside of strings
+    # buffer has to start outside of a string at the given depth
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    quotes = np.flatnonzero(data == QUOTE)
+    backslashes = np.flatnonzero(data == BACKSLASH)
+    if len(quotes) > 0 and len(backslashes) > 0:
+        # a quote right after an odd run of backslashes is escaped
+        breaks = np.flatnonzero(np.diff(backslashes) != 1)
+        run_ends = backslashes[np.append(breaks, len(backslashes) - 1)]
+        run_lengths = np.diff(np.concatenate(([-1], breaks, [len(backslashes) - 1])))
+        run_index = np.minimum(np.searchsorted(run_ends, quotes - 1), len(run_ends) - 1)
+        escaped = (run_ends[run_index] == quotes - 1) & (run_lengths[run_index] % 2 == 1)
+        quotes = quotes[~escaped]
+
+    candidates = np.flatnonzero(STRUCTURAL[data])
+    outside = np.searchsorted(quotes, candidates) % 2 == 0
+    positions = candidates[outside]
+    chars = data[positions]
+    depths = depth + np.cumsum(DEPTH_CHANGE[chars])
+    return positions, chars, depths
+
+
+def iter_array_elements(file, chunk_size=CHUNK_SIZE):
+    # (element text, file offset, structural positions, chars, depths) for each element of the top level array of a json file
+    # positions are relative to the element, depths count the top level array as 1
+    buffer = file.read(chunk_size)
+    stripped = buffer.lstrip()
+    if not stripped.startswith(b"["):
+        raise ValueError("Expected a JSON array")
+    buffer_offset = len(buffer) - len(stripped) + 1 # file offset of buffer[0]
+    buffer = stripped[1:]
+
+    read_size = chunk_size
+    finished = False
+    while True:
+        positions, chars, depths = scan_structure(buffer, 1)
+        ends = np.flatnonzero(((chars == ord(',')) & (depths == 1)) | (depths == 0))
+
+        start = 0
+        for end_index in ends:
+            end = positions[end_index]
+            element = buffer[start:end]
+            first = np.searchsorted(positions, start)
+            if element.strip():
+                yield element, buffer_offset + start, positions[first:end_index] - start, chars[first:end_index], depths[first:end_index]
+            start = end + 1
+            if depths[end_index] == 0: # closing bracket of the array
+                finished = True
+                break
+
+        if finished:
+            return
+
+        chunk = file.read(read_size)
+        if not chunk:
+            raise ValueError("Unexpected end of JSON array")
+        # an element bigger than the chunk size gets read in growing chunks instead of being rescanned for every chunk
+        read_size = chunk_size if start > 0 else read_size * 2
+        buffer = buffer[start:] + chunk
+        buffer_offset += start
+
+
+def parse_comp(element, positions, chars, depths):
+    # the positional comp array with the lazy fields left as None, and the (start, end) in the element of each of them
+    ends = positions[((chars == ord(',')) & (depths == 2)) | ((chars == ord(']')) & (depths == 1))]
+    starts = np.concatenate((positions[:1] + 1, ends[:-1] + 1))
+    spans = {index: (int(starts[index]), int(ends[index])) for index in LAZY_FIELDS if index < len(ends)}
+    if not spans:
+        return json.loads(element), spans
+
+    pieces = []
+    last = 0
+    for start, end in spans.values():
+        pieces += (element[last:start], b"null")
+        last = end
+    pieces.append(element[last:])
+    return json.loads(b"".join(pieces)), spans
+
+
+def read_lazy_array(path: str, chunk_size=CHUNK_SIZE):
+    # elements of a top level json array as LazyJSON, for files that are looked up by index like the lights
+    with open(path, 'rb') as file:
+        return [LazyJSON(element) for element, *_ in iter_array_elements(file, chunk_size)]
+
+
+# ---------- binary sidecar ----------
+# <map>.processed.bin holds the comps of <map>.processed.json, written by convert_processed_json
+#   header: magic, version, comp count, then offset and size of every section
+#   STRING_OFFSETS/STRINGS: utf-8 string table, mats, texture data and child comps are stored as their json text
+#   COMPS: one COMP_DTYPE record per comp, strings are string table indices, transforms are float64 like the json
+#   INSTANCES: float32 location, rotation and scale of every instance, the only values narrower than in the json
+#   COLORS: raw BGRA vertex colours, what the json has as base64
+# missing transforms are written as their defaults, the importer treats them the same
+
+BINARY_MAGIC = b"UMAPCOMP"
+BINARY_VERSION = 2
+BINARY_SECTIONS = ("STRING_OFFSETS", "STRINGS", "COMPS", "INSTANCES", "COLORS")
+BINARY_HEADER = struct.Struct("<8sII" + "QQ" * len(BINARY_SECTIONS))
+BINARY_ALIGNMENT = 16
+NO_STRING = 0xFFFFFFFF
+
+COMP_DTYPE = np.dtype([
+    ("instance_offset", "<u8"), # in instances
+    ("color_offset", "<u8"), # in bytes
+    ("guid", "<u4"), ("name", "<u4"), ("mesh", "<u4"), ("mats", "<u4"), ("texture_data", "<u4"), ("child_comps", "<u4"),
+    ("location", "<f8", (3,)), ("rotation", "<f8", (3,)), ("scale", "<f8", (3,)),
+    ("light_index", "<i4"),
+    ("instance_count", "<u4"),
+    ("color_size", "<u4"),
+])
+INSTANCE_DTYPE = np.dtype(("<f4", (3, 3)))
+
+
+class LazyInstances(LazyJSON):
+    # instance transforms of a comp as a view into the sidecar, turned into lists on first use
+    __slots__ = ()
+
+    def get(self):
+        if self.value is None:
+            self.value = self.text.tolist()
+        return self.value
+
+    def __bool__(self):
+        return len(self.text) > 0
+
+
+def get_sidecar_path(json_path: str):
+    return os.path.splitext(json_path)[0] + ".bin"
+
+
+class ProcessedMap:
+    # memory-mapped .processed.bin, CompTable.from_sidecar reads its columns straight from the records
+
+    def __init__(self, path: str):
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # empty file
+            self.file.close()
+            raise ValueError(f"{path} is not a processed map sidecar")
+
+        self.string_cache = {}
+        self.json_cache = {}
+        if len(self.map) < BINARY_HEADER.size:
+            self.close()
+            raise ValueError(f"{path} is not a processed map sidecar")
+
+        magic, version, self.comp_count, *sections = BINARY_HEADER.unpack_from(self.map)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a version {BINARY_VERSION} processed map sidecar")
+
+        try:
+            buffers = {name: memoryview(self.map)[offset:offset + size] for name, offset, size in zip(BINARY_SECTIONS, sections[::2], sections[1::2])}
+            self.string_offsets = np.frombuffer(buffers["STRING_OFFSETS"], dtype="<u8")
+            self.strings = buffers["STRINGS"]
+            self.comps = np.frombuffer(buffers["COMPS"], dtype=COMP_DTYPE, count=self.comp_count)
+            self.instances = np.frombuffer(buffers["INSTANCES"], dtype=INSTANCE_DTYPE)
+            self.colors = buffers["COLORS"]
+        except ValueError as e: # sections cut short by a truncated write
+            buffers = None
+            self.close()
+            raise ValueError(f"{path} is truncated: {e}") from e
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.string_offsets = self.strings = self.comps = self.instances = self.colors = None
+        self.string_cache = self.json_cache = None
+        try:
+            self.map.close()
+        except BufferError: # views handed out are still alive, the map goes when they do
+            pass
+        self.file.close()
+
+    def get_string(self, index):
+        if index == NO_STRING:
+            return None
+        string = self.string_cache.get(index)
+        if string is None:
+            start, end = self.string_offsets[index:index + 2]
+            string = self.string_cache[index] = bytes(self.strings[start:end]).decode("utf-8")
+        return string
+
+    def get_json(self, index):
+        # mats and texture data repeat a lot, comps sharing them get the same (read only) object
+        if index == NO_STRING:
+            return None
+        if index not in self.json_cache:
+            self.json_cache[index] = json.loads(self.get_string(index))
+        return self.json_cache[index]
+
+
+class CompTable:
+    # the comps of a map as columns, built before any bpy work so whole map passes run on arrays
+    # strings, material sets and texture data are interned, the *_ids columns index into meshes, material_sets
+    # and texture_sets where id 0 is None. instance data and vertex colours stay lazy, views into the sidecar
+    # or spans of the json read back when their row is built, so neither is held for the whole map
+
+    def __init__(self, count):
+        self.count = count
+        self.names = [None] * count
+        self.meshes = [None]
+        self.material_sets = [None]
+        self.texture_sets = [None]
+        self.mesh_ids = np.zeros(count, dtype=np.int32)
+        self.material_set_ids = np.zeros(count, dtype=np.int32)
+        self.texture_set_ids = np.zeros(count, dtype=np.int32)
+        self.locations = np.zeros((count, 3), dtype=np.float64)
+        self.rotations = np.zeros((count, 3), dtype=np.float64)
+        self.scales = np.ones((count, 3), dtype=np.float64)
+        self.light_indices = np.zeros(count, dtype=np.int32)
+        self.child_comps = {} # row -> child comps, only rows that have some
+        self.instance_spans = {} # row -> (file offset, size), json only
+        self.vertex_color_spans = {} # row -> (file offset, size), json only
+        self.json_file = None # the json the spans point into
+        self.source = None # ProcessedMap of a sidecar table
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+        if self.json_file is not None:
+            self.json_file.close()
+            self.json_file = None
+
+    @classmethod
+    def from_json(cls, json_path: str):
+        # rows are streamed from the json, instance data and vertex colours are only located, not decoded or kept
+        interned = ({None: 0}, {None: 0}, {None: 0})
+        values = ([None], [None], [None])
+
+        def intern(column, key, value):
+            index = interned[column].get(key)
+            if index is None:
+                index = interned[column][key] = len(values[column])
+                values[column].append(value)
+            return index
+
+        names, ids, transforms, light_indices = [], [], [], []
+        child_comps = {}
+        lazy_spans = {index: {} for index in LAZY_FIELDS}
+        with open(json_path, 'rb') as file:
+            for row, (element, offset, *structure) in enumerate(iter_array_elements(file)):
+                comp, spans = parse_comp(element, *structure)
+                names.append(comp[1])
+                ids.append((intern(0, comp[2], comp[2]), intern(1, get_json_text(comp[3]), comp[3]), intern(2, get_json_text(comp[4]), comp[4])))
+                transforms.append((comp[5] or (0, 0, 0), comp[6] or (0, 0, 0), comp[7] or (1, 1, 1)))
+                light_indices.append(comp[9] or 0)
+                if comp[8] and len(comp[8]) > 0:
+                    child_comps[row] = comp[8]
+                for index, (start, end) in spans.items():
+                    if element[start:end].strip() not in EMPTY_JSON:
+                        lazy_spans[index][row] = (offset + start, end - start)
+
+        table = cls(len(names))
+        table.names = names
+        table.meshes, table.material_sets, table.texture_sets = values
+        if names:
+            table.mesh_ids[:], table.material_set_ids[:], table.texture_set_ids[:] = np.array(ids, dtype=np.int32).T
+            table.locations[:], table.rotations[:], table.scales[:] = np.array(transforms, dtype=np.float64).transpose(1, 0, 2)
+            table.light_indices[:] = light_indices
+        table.child_comps = child_comps
+        table.instance_spans = lazy_spans[INSTANCE_DATA_INDEX]
+        table.vertex_color_spans = lazy_spans[VERTEX_COLOR_INDEX]
+        table.json_file = open(json_path, 'rb')
+        return table
+
+    @classmethod
+    def from_sidecar(cls, processed_map: "ProcessedMap"):
+        # the columns are read straight from the records, strings are decoded once per distinct index
+        records = processed_map.comps
+        table = cls(len(records))
+        table.source = processed_map
+        table.names = [processed_map.get_string(index) for index in records["name"].tolist()]
+        for column, values, ids, decode in (("mesh", table.meshes, table.mesh_ids, processed_map.get_string),
+                                            ("mats", table.material_sets, table.material_set_ids, processed_map.get_json),
+                                            ("texture_data", table.texture_sets, table.texture_set_ids, processed_map.get_json)):
+            unique, inverse = np.unique(records[column], return_inverse=True)
+            values += [decode(int(index)) for index in unique]
+            ids[:] = inverse + 1
+            ids[records[column] == NO_STRING] = 0
+        table.locations[:] = records["location"]
+        table.rotations[:] = records["rotation"]
+        table.scales[:] = records["scale"]
+        table.light_indices[:] = records["light_index"]
+        for row in np.flatnonzero(records["child_comps"] != NO_STRING).tolist():
+            table.child_comps[row] = processed_map.get_json(records["child_comps"][row])
+        return table
+
+    @classmethod
+    def from_path(cls, json_path: str):
+        # from the binary sidecar when there is one at least as new as the json, from the json otherwise
+        # a stale or corrupt sidecar only costs the faster load, the json is still there to import from
+        sidecar_path = get_sidecar_path(json_path)
+        if os.path.exists(sidecar_path) and (not os.path.exists(json_path) or os.path.getmtime(sidecar_path) >= os.path.getmtime(json_path)):
+            processed_map = None
+            try:
+                processed_map = ProcessedMap(sidecar_path)
+                return cls.from_sidecar(processed_map)
+            except ValueError as e: # also json and unicode errors from the string table
+                if processed_map is not None:
+                    processed_map.close()
+                if not os.path.exists(json_path):
+                    raise
+                print("WARNING: Ignoring processed map sidecar, loading the json instead:", e)
+        return cls.from_json(json_path)
+
+    @property
+    def has_children(self):
+        has_children = np.zeros(self.count, dtype=bool)
+        has_children[list(self.child_comps)] = True
+        return has_children
+
+    def get_order(self):
+        # rows with child comps last, what sort_comps did to the comp list
+        has_children = self.has_children
+        return np.concatenate((np.flatnonzero(~has_children), np.flatnonzero(has_children)))
+
+    def read_span(self, span):
+        offset, size = span
+        self.json_file.seek(offset)
+        return self.json_file.read(size)
+
+    def get_instances(self, row):
+        # a new LazyJSON every call, the decoded instances go with the row that asked for them
+        if self.source is None:
+            span = self.instance_spans.get(row)
+            return LazyJSON(self.read_span(span)) if span is not None else None
+        record = self.source.comps[row]
+        if record["instance_count"] == 0:
+            return None
+        offset = int(record["instance_offset"])
+        return LazyInstances(self.source.instances[offset:offset + int(record["instance_count"])])
+
+    def get_vertex_color_rows(self):
+        if self.source is None:
+            return np.array(sorted(self.vertex_color_spans), dtype=np.int64)
+        return np.flatnonzero(self.source.comps["color_size"] > 0)
+
+    def get_vertex_color(self, row):
+        # base64 text from the json, raw BGRA bytes from the sidecar
+        if self.source is None:
+            span = self.vertex_color_spans.get(row)
+            return json.loads(self.read_span(span)) if span is not None else None
+        record = self.source.comps[row]
+        if record["color_size"] == 0:
+            return None
+        offset = int(record["color_offset"])
+        return bytes(self.source.colors[offset:offset + int(record["color_size"])])
+
+
+def get_json_text(value):
+    if value is None:
+        return None
+    return json.dumps(value, separators=(",", ":"))
+
+
+def pad_to(file, alignment=BINARY_ALIGNMENT):
+    file.write(b"\x00" * (-file.tell() % alignment))
+
+
+def convert_processed_json(json_path: str, sidecar_path: str = None):
+    # writes the sidecar for a .processed.json, comps are streamed so this runs on maps that don't fit in memory as json
+    sidecar_path = sidecar_path or get_sidecar_path(json_path)
+    strings = {}
+
+    def intern(value):
+        if value is None:
+            return NO_STRING
+        index = strings.get(value)
+        if index is None:
+            index = strings[value] = len(strings)
+        return index
+
+    records = []
+    instance_count = 0
+    color_size = 0
+    with tempfile.TemporaryFile() as instances, tempfile.TemporaryFile() as colors:
+        with open(json_path, 'rb') as file:
+            for element, _, *structure in iter_array_elements(file):
+                comp, spans = parse_comp(element, *structure)
+                for index, (start, end) in spans.items():
+                    comp[index] = json.loads(element[start:end])
+                record = np.zeros((), dtype=COMP_DTYPE)
+                record["guid"] = intern(comp[0])
+                record["name"] = intern(comp[1])
+                record["mesh"] = intern(comp[2])
+                record["mats"] = intern(get_json_text(comp[3]))
+                record["texture_data"] = intern(get_json_text(comp[4]))
+                record["location"] = comp[5] or [0, 0, 0]
+                record["rotation"] = comp[6] or [0, 0, 0]
+                record["scale"] = comp[7] or [1, 1, 1]
+                record["child_comps"] = intern(get_json_text(comp[8] or None)) # empty lists as no string, the reader finds comps with children by it
+                record["light_index"] = comp[9] or 0
+
+                instance_data = comp[10] if len(comp) > 10 else None
+                if instance_data:
+                    transforms = np.asarray(instance_data, dtype="<f4").reshape(-1, 3, 3)
+                    record["instance_offset"] = instance_count
+                    record["instance_count"] = len(transforms)
+                    instances.write(transforms.tobytes())
+                    instance_count += len(transforms)
+
+                vertex_color = comp[11] if len(comp) > 11 else None
+                if vertex_color:
+                    decoded = base64.b64decode(vertex_color)
+                    record["color_offset"] = color_size
+                    record["color_size"] = len(decoded)
+                    colors.write(decoded)
+                    color_size += len(decoded)
+                records.append(record)
+
+        encoded = [string.encode("utf-8") for string in strings]
+        string_offsets = np.zeros(len(encoded) + 1, dtype="<u8")
+        np.cumsum([len(string) for string in encoded], out=string_offsets[1:])
+        comps = np.array(records, dtype=COMP_DTYPE)
+
+        temp_path = sidecar_path + ".tmp"
+        with open(temp_path, 'wb') as file:
+            file.write(b"\x00" * BINARY_HEADER.size)
+            sections = []
+            for name in BINARY_SECTIONS:
+                pad_to(file)
+                offset = file.tell()
+                if name == "STRING_OFFSETS":
+                    file.write(string_offsets.tobytes())
+                elif name == "STRINGS":
+                    file.writelines(encoded)
+                elif name == "COMPS":
+                    file.write(comps.tobytes())
+                else:
+                    source = instances if name == "INSTANCES" else colors
+                    source.seek(0)
+                    shutil.copyfileobj(source, file)
+                sections += (offset, file.tell() - offset)
+
+            file.seek(0)
+            file.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(comps), *sections))
+        os.replace(temp_path, sidecar_path)
+    return sidecar_path
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert .processed.json map files to .processed.bin sidecars")
+    parser.add_argument("paths", nargs="+", help=".processed.json files, or export folders to convert every map in")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        json_paths = [path]
+        if os.path.isdir(path):
+            json_paths = [os.path.join(root, name) for root, _, names in os.walk(path) for name in names
+                          if name.endswith(".processed.json") and not name.endswith(".lights.processed.json") and name != "processed.json"]
+        for json_path in json_paths:
+            start = time.perf_counter()
+            sidecar_path = convert_processed_json(json_path)
+            print(f"{json_path} -> {sidecar_path} ({os.path.getsize(json_path) / 1024 ** 2:.1f} MB -> "
+                  f"{os.path.getsize(sidecar_path) / 1024 ** 2:.1f} MB, {time.perf_counter() - start:.2f}s)")
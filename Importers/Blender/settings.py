@@ -20,9 +20,51 @@ class BlenderUmapPreferences(AddonPreferences): # TODO: Finished it
         default=True
     )
 
+    bUseMeshCache: bpy.props.BoolProperty(
+        name="Cache Decoded Meshes",
+        description="Store decoded meshes in uemodel_cache in the export folder, unchanged meshes load from it on the next import. Uses up to the cache size of disk space in the export folder.",
+        default=False
+    )
+
+    mesh_cache_size: bpy.props.IntProperty(
+        name="Mesh Cache Size (MB)",
+        description="Least recently used meshes are removed from the cache above this size.",
+        default=4096,
+        min=64
+    )
+
+    mesh_prefetch_threads: bpy.props.IntProperty(
+        name="Mesh Prefetch Threads",
+        description="Threads decoding upcoming meshes while the current ones are built, 0 decodes them on the main thread.",
+        default=4,
+        min=0,
+        max=32
+    )
+
+    profile_every_nth: bpy.props.IntProperty(
+        name="Profile Every Nth Mesh",
+        description="Profile every Nth imported mesh and write the summed up stats to the export folder, 0 disables it.",
+        default=0,
+        min=0
+    )
+
+    profile_min_size: bpy.props.FloatProperty(
+        name="Profile Meshes Over (MB)",
+        description="Profile every mesh file at least this big, 0 disables it.",
+        default=0.0,
+        min=0.0
+    )
+
     def draw(self, context: bpy.types.Context):
         layout: UILayout = self.layout
         layout.prop(self, "bMultiProcessImport")
+        layout.prop(self, "bUseMeshCache")
+        row = layout.row()
+        row.enabled = self.bUseMeshCache
+        row.prop(self, "mesh_cache_size")
+        layout.prop(self, "mesh_prefetch_threads")
+        layout.prop(self, "profile_every_nth")
+        layout.prop(self, "profile_min_size")
         layout.prop(self, "filepath")
         fp = context.preferences.addons[__package__].preferences.get("filepath")
         if fp is not None and fp != "" and not os.path.exists(fp):
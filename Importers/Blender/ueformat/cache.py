@@ -0,0 +1,207 @@
+import os
+import json
+import shutil
+import hashlib
+import argparse
+import threading
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from .decoder import Log, EUEFormatVersion, STATIC_MESH_SECTIONS, UEModel, VertexColor, Material, read_uemodel_file
+except ImportError: # run as a script for prewarming
+    from decoder import Log, EUEFormatVersion, STATIC_MESH_SECTIONS, UEModel, VertexColor, Material, read_uemodel_file
+
+# bump when the layout of an entry changes, old entries are then never hit and get evicted
+CACHE_VERSION = 1
+DEFAULT_MAX_SIZE = 4 * 1024 ** 3
+
+
+def get_cache_dir(data_dir):
+    return os.path.join(data_dir, "uemodel_cache")
+
+
+class MeshCache:
+    # decoded static meshes stored as .npy files, loading one is a memory map instead of parsing and decompressing
+    # entries are keyed by the .uemodel path, size and mtime, so a re-export is a miss and its old entry ages out
+    # load and store are called from the prefetch threads, the counters and eviction are guarded by lock
+
+    def __init__(self, root, max_size=DEFAULT_MAX_SIZE):
+        self.root = root
+        self.max_size = max_size
+        self.written = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def accepts(scale_factor, sections):
+        # skeletal data isn't cached, meshes carrying it are rare and built once
+        return sections is not None and sections <= STATIC_MESH_SECTIONS
+
+    def get_key(self, path, scale_factor, sections):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        key = "|".join((os.path.normcase(os.path.abspath(path)), str(stat.st_size), str(stat.st_mtime_ns),
+                        str(int(EUEFormatVersion.LatestVersion)), str(CACHE_VERSION), repr(float(scale_factor)),
+                        ",".join(sorted(sections))))
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def load(self, path, scale_factor, sections):
+        key = self.get_key(path, scale_factor, sections)
+        if key is None:
+            return
+
+        entry = os.path.join(self.root, key)
+        meta_path = os.path.join(entry, "meta.json")
+        try:
+            with open(meta_path, 'r') as file:
+                meta = json.load(file)
+
+            data = UEModel()
+            arrays = {name: np.load(os.path.join(entry, name + ".npy"), mmap_mode='r') for name in meta["arrays"]}
+            data.vertices = arrays.get("vertices", [])
+            data.indices = arrays.get("indices", [])
+            data.normals = arrays.get("normals", [])
+            data.uvs = [arrays[f"uv{index}"] for index in range(meta["uvs"])]
+            data.colors = [VertexColor(name, arrays[f"color{index}"]) for index, name in enumerate(meta["colors"])]
+            data.materials = [Material(*material) for material in meta["materials"]]
+            os.utime(meta_path) # mtime of meta.json is the last use for eviction
+        except (OSError, ValueError, KeyError):
+            with self.lock:
+                self.misses += 1
+            return
+
+        with self.lock:
+            self.hits += 1
+        return meta["name"], data
+
+    def store(self, path, scale_factor, sections, name, data):
+        key = self.get_key(path, scale_factor, sections)
+        if key is None:
+            return
+
+        arrays = {}
+        if len(data.vertices) > 0:
+            arrays["vertices"] = data.vertices
+        if len(data.indices) > 0:
+            arrays["indices"] = data.indices
+        if len(data.normals) > 0:
+            arrays["normals"] = data.normals
+        for index, uv in enumerate(data.uvs):
+            arrays[f"uv{index}"] = uv
+        for index, color in enumerate(data.colors):
+            arrays[f"color{index}"] = color.data
+
+        meta = {
+            "name": name,
+            "arrays": list(arrays),
+            "uvs": len(data.uvs),
+            "colors": [color.name for color in data.colors],
+            "materials": [(material.material_name, material.first_index, material.num_faces) for material in data.materials],
+        }
+
+        # written to a temporary folder and renamed, readers never see a partial entry
+        entry = os.path.join(self.root, key)
+        temp = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp" # unique per process and thread
+        size = 0
+        try:
+            os.makedirs(temp, exist_ok=True)
+            for array_name, array in arrays.items():
+                array_path = os.path.join(temp, array_name + ".npy")
+                np.save(array_path, np.ascontiguousarray(array))
+                size += os.path.getsize(array_path)
+            with open(os.path.join(temp, "meta.json"), 'w') as file:
+                json.dump(meta, file)
+            os.replace(temp, entry)
+        except OSError: # another process stored the same entry first or the disk is full
+            shutil.rmtree(temp, ignore_errors=True)
+            return
+
+        with self.lock:
+            self.written += size
+            if self.written > self.max_size // 10:
+                self.evict_locked()
+
+    def evict(self):
+        with self.lock:
+            self.evict_locked()
+
+    def evict_locked(self):
+        # oldest used entries go first until the cache fits in max_size
+        self.written = 0
+        entries = []
+        total = 0
+        for entry in os.scandir(self.root):
+            if not entry.is_dir():
+                continue
+            try:
+                size = sum(file.stat().st_size for file in os.scandir(entry.path))
+                used = os.stat(os.path.join(entry.path, "meta.json")).st_mtime
+            except OSError: # unfinished or broken entry
+                used = 0
+                size = 0
+            entries.append((used, size, entry.path))
+            total += size
+
+        entries.sort()
+        for used, size, path in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        with self.lock:
+            shutil.rmtree(self.root, ignore_errors=True)
+            os.makedirs(self.root, exist_ok=True)
+            self.written = 0
+
+
+# ---------- PREWARM ---------- #
+
+def prewarm_file(args):
+    root, max_size, path, scale_factor = args
+    cache = MeshCache(root, max_size)
+    sections = STATIC_MESH_SECTIONS
+    if cache.load(path, scale_factor, sections) is not None:
+        return 0
+
+    decoded = read_uemodel_file(path, scale_factor, sections)
+    if decoded is None:
+        return 0
+    cache.store(path, scale_factor, sections, *decoded)
+    return 1
+
+
+def prewarm(export_dir, root=None, max_size=DEFAULT_MAX_SIZE, scale_factor=0.01, workers=None):
+    # decodes every .uemodel of an export in parallel, a following map import then only memory maps them
+    root = root or get_cache_dir(export_dir)
+    paths = []
+    for directory, _, files in os.walk(export_dir):
+        paths.extend(os.path.join(directory, file) for file in files if file.lower().endswith(".uemodel"))
+
+    stored = 0
+    with ProcessPoolExecutor(workers) as executor:
+        tasks = ((root, max_size, path, scale_factor) for path in paths)
+        for result in executor.map(prewarm_file, tasks, chunksize=16):
+            stored += result
+
+    MeshCache(root, max_size).evict()
+    return len(paths), stored
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Decode the .uemodel files of an export into the mesh cache")
+    parser.add_argument("export_dir")
+    parser.add_argument("--cache-dir", default=None, help="defaults to uemodel_cache in the export directory")
+    parser.add_argument("--max-size", type=int, default=DEFAULT_MAX_SIZE // 1024 ** 2, help="cache size limit in MB")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    Log.NoLog = True
+    found, stored = prewarm(args.export_dir, args.cache_dir, args.max_size * 1024 ** 2, workers=args.workers)
+    print(f"{found} models found, {stored} added to the cache")
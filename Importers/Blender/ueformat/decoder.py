@@ -0,0 +1,659 @@
+import os
+import mmap
+import time
+import zlib
+import struct
+import threading
+import tracemalloc
+import numpy as np
+import zstandard as zstd
+from contextlib import contextmanager
+from enum import IntEnum, auto
+
+# bpy-free part of the importer, safe to use from worker threads/processes and outside of Blender
+# decodes .uemodel/.ueanim files into numpy backed records, ue_format.py builds Blender data from them
+
+# ---------- DECODING ---------- #
+
+# decompression contexts can't be shared between threads, every thread creates its own on first use
+zstd_contexts = threading.local()
+
+
+def get_zstd_decompresser():
+    decompresser = getattr(zstd_contexts, "decompresser", None)
+    if decompresser is None:
+        decompresser = zstd_contexts.decompresser = zstd.ZstdDecompressor()
+    return decompresser
+
+
+# compressed bodies are streamed in chunks of this size straight into a buffer of the uncompressed size
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+def zstd_decompress_into(source, size: int):
+    buffer = np.empty(size, dtype=np.uint8)
+    output = memoryview(buffer)
+    filled = 0
+    with get_zstd_decompresser().stream_reader(source, read_size=STREAM_CHUNK_SIZE) as reader:
+        while filled < size:
+            read = reader.readinto(output[filled:])
+            if read == 0:
+                break
+            filled += read
+    output.release()
+    return buffer[:filled]
+
+
+def gzip_decompress_into(source, size: int):
+    buffer = np.empty(size, dtype=np.uint8)
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    source = memoryview(source)
+    filled = 0
+    for start in range(0, source.nbytes, STREAM_CHUNK_SIZE):
+        # max_length keeps a chunk from running past the buffer, leftover input stays in unconsumed_tail
+        pending = source[start:start + STREAM_CHUNK_SIZE]
+        while pending and filled < size:
+            chunk = decompressor.decompress(pending, size - filled)
+            buffer[filled:filled + len(chunk)] = np.frombuffer(chunk, dtype=np.uint8)
+            filled += len(chunk)
+            pending = decompressor.unconsumed_tail
+        if filled >= size or decompressor.eof:
+            break
+    return buffer[:filled]
+
+
+def bytes_to_str(in_bytes):
+    return in_bytes.rstrip(b'\x00').decode()
+
+
+class Log:
+    INFO = u"\u001b[36m"
+    ERROR = u"\u001b[33m"
+    RESET = u"\u001b[0m"
+
+    NoLog = False
+
+    @staticmethod
+    def info(message):
+        if Log.NoLog: return
+        print(f"{Log.INFO}[UEFORMAT] {Log.RESET}{message}")
+
+    @staticmethod
+    def error(message):
+        if Log.NoLog: return
+        print(f"{Log.ERROR}[UEFORMAT] {Log.RESET}{message}")
+
+    timers = {}
+
+    @staticmethod
+    def time_start(name):
+        if Log.NoLog: return
+        Log.timers[name] = time.time()
+    
+    @staticmethod
+    def time_end(name):
+        if Log.NoLog: return
+        if name in Log.timers:
+            Log.info(f"{name} took {time.time() - Log.timers[name]} seconds")
+            del Log.timers[name]
+        else:
+            Log.error(f"Timer {name} does not exist")
+
+    memory_traces = {}
+
+    @staticmethod
+    def memory_start(name):
+        if Log.NoLog: return
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        Log.memory_traces[name] = (started, tracemalloc.get_traced_memory()[0])
+        tracemalloc.reset_peak()
+
+    @staticmethod
+    def memory_end(name):
+        if Log.NoLog: return
+        if name in Log.memory_traces:
+            started, baseline = Log.memory_traces.pop(name)
+            peak = tracemalloc.get_traced_memory()[1] - baseline
+            if started:
+                tracemalloc.stop()
+            Log.info(f"{name} peak memory {peak / 1024 ** 2:.2f} MiB")
+        else:
+            Log.error(f"Memory trace {name} does not exist")
+
+# precompiled layouts shared by all readers, unpack_from reads them straight from the buffer
+BOOL = struct.Struct("<?")
+BYTE = struct.Struct("<c")
+SHORT = struct.Struct("<h")
+INT = struct.Struct("<i")
+FLOAT = struct.Struct("<f")
+
+structs = {}
+
+def get_struct(fmt: str) -> struct.Struct:
+    layout = structs.get(fmt)
+    if layout is None:
+        layout = structs[fmt] = struct.Struct(fmt)
+    return layout
+
+
+class FArchiveReader:
+    data = None
+    size = 0
+
+    # data can be anything exposing the buffer protocol (bytes, mmap, numpy array), it is never copied
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.size = self.data.nbytes
+        self.offset = 0
+
+    def __enter__(self):
+        self.offset = 0
+        return self
+
+    def __exit__(self, type, value, traceback):
+        try:
+            self.data.release()
+        except BufferError: # numpy views still reference the buffer, it is freed together with them
+            pass
+
+    def eof(self):
+        return self.offset >= self.size
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset: int):
+        self.offset = offset
+
+    def read(self, size: int):
+        return self.read_view(size).tobytes()
+
+    def read_view(self, size: int):
+        start = self.offset
+        self.offset = min(start + size, self.size)
+        return self.data[start:self.offset]
+
+    def read_to_end(self):
+        return self.read_view(self.size - self.offset)
+
+    def read_struct(self, layout: struct.Struct):
+        values = layout.unpack_from(self.data, self.offset)
+        self.offset += layout.size
+        return values
+
+    def read_bool(self):
+        value, = BOOL.unpack_from(self.data, self.offset)
+        self.offset += 1
+        return value
+
+    def read_string(self, size: int):
+        start = self.offset
+        self.offset += size
+        return bytes_to_str(self.data[start:self.offset].tobytes())
+
+    def read_fstring(self):
+        size, = INT.unpack_from(self.data, self.offset)
+        start = self.offset + 4
+        self.offset = start + size
+        return bytes_to_str(self.data[start:self.offset].tobytes())
+
+    def read_int(self):
+        value, = INT.unpack_from(self.data, self.offset)
+        self.offset += 4
+        return value
+
+    def read_int_vector(self, size: int):
+        return self.read_struct(get_struct(f"<{size}I"))
+
+    def read_short(self):
+        value, = SHORT.unpack_from(self.data, self.offset)
+        self.offset += 2
+        return value
+
+    def read_byte(self):
+        value, = BYTE.unpack_from(self.data, self.offset)
+        self.offset += 1
+        return value
+
+    def read_float(self):
+        value, = FLOAT.unpack_from(self.data, self.offset)
+        self.offset += 4
+        return value
+
+    def read_float_vector(self, size: int):
+        return self.read_struct(get_struct(f"<{size}f"))
+
+    def read_byte_vector(self, size: int):
+        return self.read_struct(get_struct(f"<{size}B"))
+
+    # bulk readers return read-only numpy views over the archive buffer, no tuples or float64 copies
+    def read_numpy_array(self, dtype, count: int):
+        array = np.frombuffer(self.data, dtype=dtype, count=count, offset=self.offset)
+        self.offset += array.nbytes
+        return array
+
+    def read_float_array(self, count: int):
+        return self.read_numpy_array("<f4", count)
+
+    def read_int_array(self, count: int):
+        return self.read_numpy_array("<i4", count)
+
+    def read_byte_array(self, count: int):
+        return self.read_numpy_array(np.uint8, count)
+
+    def skip(self, size: int):
+        self.offset += size
+
+    def read_bulk_array(self, predicate):
+        count = self.read_int()
+        return self.read_array(count, predicate)
+
+    def read_array(self, count, predicate):
+        array = []
+        for counter in range(count):
+            array.append(predicate(self))
+        return array
+
+
+MAGIC = "UEFORMAT"
+MODEL_IDENTIFIER = "UEMODEL"
+ANIM_IDENTIFIER = "UEANIM"
+
+# sections a static mesh placed in a map is built from, everything else is skipped without decoding
+STATIC_MESH_SECTIONS = frozenset(("VERTICES", "INDICES", "NORMALS", "VERTEXCOLORS", "TEXCOORDS", "MATERIALS"))
+
+
+def read_section_index(ar: FArchiveReader):
+    # header_name -> (array_size, offset, byte_size) in file order, payloads are skipped not decoded
+    sections = {}
+    while not ar.eof():
+        header_name = ar.read_fstring()
+        array_size = ar.read_int()
+        byte_size = ar.read_int()
+        sections[header_name] = (array_size, ar.tell(), byte_size)
+        ar.skip(byte_size)
+    return sections
+
+
+class EUEFormatVersion(IntEnum):
+    BeforeCustomVersionWasAdded = 0
+    SerializeBinormalSign = 1
+    AddMultipleVertexColors = 2
+
+    VersionPlusOne = auto()
+    LatestVersion = VersionPlusOne - 1
+
+
+def read_header(ar: FArchiveReader):
+    # (identifier, file_version, object_name), None if the data is not a supported UEFormat file
+    magic = ar.read_string(len(MAGIC))
+    if magic != MAGIC:
+        return
+
+    identifier = ar.read_fstring()
+    file_version = EUEFormatVersion(int.from_bytes(ar.read_byte(), byteorder="big"))
+    if file_version > EUEFormatVersion.LatestVersion:
+        Log.error(f"File Version {file_version} is not supported for this version of the importer.")
+        return
+    object_name = ar.read_fstring()
+    return identifier, file_version, object_name
+
+
+def read_body(ar: FArchiveReader):
+    # archive positioned at the first section, decompressed if needed
+    is_compressed = ar.read_bool()
+    if not is_compressed:
+        return ar
+
+    compression_type = ar.read_fstring()
+    uncompressed_size = ar.read_int()
+    ar.skip(4) # compressed size, the payload runs to the end of the file
+
+    # the compressed payload is read as a view and decompressed into one preallocated buffer
+    if compression_type == "GZIP":
+        return FArchiveReader(gzip_decompress_into(ar.read_to_end(), uncompressed_size))
+    elif compression_type == "ZSTD":
+        return FArchiveReader(zstd_decompress_into(ar.read_to_end(), uncompressed_size))
+    else:
+        Log.info(f"Unknown Compression Type: {compression_type}")
+
+
+def read_uemodel(ar: FArchiveReader, file_version, scale_factor=0.01, sections=None):
+    data = UEModel()
+
+    for header_name, (array_size, pos, byte_size) in read_section_index(ar).items():
+        if sections is not None and header_name not in sections:
+            continue
+
+        ar.seek(pos)
+        if header_name == "VERTICES":
+            data.vertices = ar.read_float_array(array_size * 3).reshape(array_size, 3) * np.float32(scale_factor)
+        elif header_name == "INDICES":
+            data.indices = ar.read_int_array(array_size).reshape(array_size // 3, 3)
+        elif header_name == "NORMALS":
+            if file_version >= EUEFormatVersion.SerializeBinormalSign:
+                flattened = ar.read_float_array(array_size * 4) # W XYZ # TODO: change to XYZ W
+                data.normals = flattened.reshape(-1,4)[:,1:]
+            else:
+                data.normals = ar.read_float_array(array_size * 3).reshape(array_size, 3)
+        elif header_name == "TANGENTS":
+            ar.skip(array_size * 3 * 3)
+            # flattened = np.array(ar.read_float_vector(array_size * 3)).reshape(array_size, 3)
+        elif header_name == "VERTEXCOLORS":
+            if file_version >= EUEFormatVersion.AddMultipleVertexColors:
+                data.colors = []
+                for i in range(array_size):
+                    data.colors.append(VertexColor.read(ar))
+            else:
+                count = ar.read_int()
+                data.colors = [VertexColor("COL0", ar.read_byte_array(count * 4).reshape(count, 4))]
+        elif header_name == "TEXCOORDS":
+            data.uvs = []
+            for i in range(array_size):
+                count = ar.read_int()
+                data.uvs.append(ar.read_float_array(count * 2).reshape(count, 2))
+        elif header_name == "MATERIALS":
+            data.materials = ar.read_array(array_size, Material.read)
+        elif header_name == "WEIGHTS":
+            data.weights = Weight.read_array(ar, array_size)
+        elif header_name == "BONES":
+            data.bones = ar.read_array(array_size, lambda ar: Bone.read(ar, scale_factor))
+        elif header_name == "MORPHTARGETS":
+            data.morphs = ar.read_array(array_size, lambda ar: MorphTarget.read(ar, scale_factor))
+        elif header_name == "SOCKETS":
+            data.sockets = ar.read_array(array_size, lambda ar: Socket.read(ar, scale_factor))
+
+    return data
+
+
+def read_ueanim(ar: FArchiveReader, scale_factor=0.01, sections=None):
+    data = UEAnim()
+
+    data.num_frames = ar.read_int()
+    data.frames_per_second = ar.read_float()
+
+    while not ar.eof():
+        header_name = ar.read_fstring()
+        array_size = ar.read_int()
+        byte_size = ar.read_int()
+
+        if sections is not None and header_name not in sections:
+            ar.skip(byte_size)
+        elif header_name == "TRACKS":
+            data.tracks = ar.read_array(array_size, lambda ar: Track.read(ar, scale_factor))
+        elif header_name == "CURVES":
+            data.curves = ar.read_array(array_size, Curve.read)
+        else:
+            ar.skip(byte_size)
+
+    return data
+
+
+@contextmanager
+def map_file(path: str):
+    # uncompressed files are read in place from the page cache
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0: # empty files can't be mapped
+            yield b""
+            return
+
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mapped
+        finally:
+            try:
+                mapped.close()
+            except BufferError: # decoded arrays still view the mapping, it is unmapped once they are gone
+                pass
+
+
+def read_data(data, scale_factor=0.01, sections=None):
+    # (identifier, object_name, UEModel or UEAnim) without creating any Blender data, None for unsupported data
+    with FArchiveReader(data) as ar:
+        header = read_header(ar)
+        if header is None:
+            return
+        identifier, file_version, object_name = header
+
+        body = read_body(ar)
+        if body is None:
+            return
+
+        if identifier == MODEL_IDENTIFIER:
+            return identifier, object_name, read_uemodel(body, file_version, scale_factor, sections)
+        elif identifier == ANIM_IDENTIFIER:
+            return identifier, object_name, read_ueanim(body, scale_factor)
+
+
+def read_file(path: str, scale_factor=0.01, sections=None):
+    with map_file(path) as data:
+        return read_data(data, scale_factor, sections)
+
+
+def read_uemodel_file(path: str, scale_factor=0.01, sections=None):
+    # (object_name, UEModel), None for anything that isn't a model
+    decoded = read_file(path, scale_factor, sections)
+    if decoded is None or decoded[0] != MODEL_IDENTIFIER:
+        return
+    return decoded[1], decoded[2]
+
+
+def read_ueanim_file(path: str, scale_factor=0.01):
+    # (object_name, UEAnim), None for anything that isn't an animation
+    decoded = read_file(path, scale_factor)
+    if decoded is None or decoded[0] != ANIM_IDENTIFIER:
+        return
+    return decoded[1], decoded[2]
+
+
+class UEModel:
+    __slots__ = ("vertices", "indices", "normals", "tangents", "colors", "uvs", "materials", "morphs", "weights", "bones", "sockets")
+
+    def __init__(self):
+        self.vertices = []
+        self.indices = []
+        self.normals = []
+        self.tangents = []
+        self.colors = []
+        self.uvs = []
+        self.materials = []
+        self.morphs = []
+        self.weights = []
+        self.bones = []
+        self.sockets = []
+
+
+class VertexColor:
+    __slots__ = ("name", "data")
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+
+    @classmethod
+    def read(cls, ar: FArchiveReader):
+        name = ar.read_fstring()
+        count = ar.read_int()
+        data = np.divide(ar.read_byte_array(count * 4).reshape(count, 4), 255, dtype=np.float32)
+
+        return cls(name, data)
+
+
+class Material:
+    __slots__ = ("material_name", "first_index", "num_faces")
+
+    def __init__(self, material_name, first_index, num_faces):
+        self.material_name = material_name
+        self.first_index = first_index
+        self.num_faces = num_faces
+
+    @classmethod
+    def read(cls, ar: FArchiveReader):
+        return cls(ar.read_fstring(), ar.read_int(), ar.read_int())
+
+
+class Bone:
+    __slots__ = ("name", "parent_index", "position", "rotation")
+
+    def __init__(self, name, parent_index, position, rotation):
+        self.name = name
+        self.parent_index = parent_index
+        self.position = position
+        self.rotation = rotation # XYZW
+
+    @classmethod
+    def read(cls, ar: FArchiveReader, scale):
+        name = ar.read_fstring()
+        parent_index = ar.read_int()
+        transform = ar.read_float_array(7)
+        return cls(name, parent_index, transform[:3] * np.float32(scale), transform[3:])
+
+
+class Weight:
+    __slots__ = ()
+
+    # packed like the file: int16 bone index, int32 vertex index, float32 weight
+    dtype = np.dtype([("bone_index", "<i2"), ("vertex_index", "<i4"), ("weight", "<f4")])
+
+    @staticmethod
+    def read_array(ar: FArchiveReader, count: int):
+        return ar.read_numpy_array(Weight.dtype, count)
+
+
+class MorphTarget:
+    __slots__ = ("name", "positions", "vertex_indices")
+
+    def __init__(self, name, positions, vertex_indices):
+        self.name = name
+        self.positions = positions
+        self.vertex_indices = vertex_indices
+
+    @classmethod
+    def read(cls, ar: FArchiveReader, scale):
+        name = ar.read_fstring()
+        deltas = MorphTargetData.read_array(ar, ar.read_int())
+        return cls(name, deltas["position"] * np.float32(scale), deltas["vertex_index"])
+
+
+class MorphTargetData:
+    __slots__ = ()
+
+    # packed like the file: float32 position[3], float32 normals[3], int32 vertex index
+    dtype = np.dtype([("position", "<f4", (3,)), ("normals", "<f4", (3,)), ("vertex_index", "<i4")])
+
+    @staticmethod
+    def read_array(ar: FArchiveReader, count: int):
+        return ar.read_numpy_array(MorphTargetData.dtype, count)
+
+
+class Socket:
+    __slots__ = ("name", "parent_name", "position", "rotation", "scale")
+
+    def __init__(self, name, parent_name, position, rotation, scale):
+        self.name = name
+        self.parent_name = parent_name
+        self.position = position
+        self.rotation = rotation # XYZW
+        self.scale = scale
+
+    @classmethod
+    def read(cls, ar: FArchiveReader, scale):
+        name = ar.read_fstring()
+        parent_name = ar.read_fstring()
+        transform = ar.read_float_array(10)
+        return cls(name, parent_name, transform[:3] * np.float32(scale), transform[3:7], transform[7:])
+
+
+class UEAnim:
+    __slots__ = ("num_frames", "frames_per_second", "tracks", "curves")
+
+    def __init__(self):
+        self.num_frames = 0
+        self.frames_per_second = 0
+        self.tracks = []
+        self.curves = []
+
+
+class Curve:
+    __slots__ = ("name", "keys")
+
+    def __init__(self, name, keys):
+        self.name = name
+        self.keys = keys
+
+    @classmethod
+    def read(cls, ar: FArchiveReader):
+        return cls(ar.read_fstring(), FloatKey.read_bulk_array(ar))
+
+
+class Track:
+    __slots__ = ("name", "position_keys", "rotation_keys", "scale_keys")
+
+    def __init__(self, name, position_keys, rotation_keys, scale_keys):
+        self.name = name
+        self.position_keys = position_keys
+        self.rotation_keys = rotation_keys
+        self.scale_keys = scale_keys
+
+    @classmethod
+    def read(cls, ar: FArchiveReader, scale):
+        name = ar.read_fstring()
+        position_keys = VectorKey.read_bulk_array(ar, scale)
+        rotation_keys = QuatKey.read_bulk_array(ar)
+        scale_keys = VectorKey.read_bulk_array(ar)
+        return cls(name, position_keys, rotation_keys, scale_keys)
+
+
+# keys are record arrays laid out like the file, key["frame"] and key["value"] are columns over all keys
+
+class AnimKey:
+    __slots__ = ()
+
+    dtype = None
+
+    @classmethod
+    def read_bulk_array(cls, ar: FArchiveReader):
+        return ar.read_numpy_array(cls.dtype, ar.read_int())
+
+
+class VectorKey(AnimKey):
+    # int32 frame, float32 value[3]
+    dtype = np.dtype([("frame", "<i4"), ("value", "<f4", (3,))])
+
+    @classmethod
+    def read_bulk_array(cls, ar: FArchiveReader, multiplier=1):
+        keys = super().read_bulk_array(ar)
+        if multiplier != 1:
+            keys = keys.copy()
+            keys["value"] *= np.float32(multiplier)
+        return keys
+
+
+class QuatKey(AnimKey):
+    # int32 frame, float32 value[4] as XYZW
+    dtype = np.dtype([("frame", "<i4"), ("value", "<f4", (4,))])
+
+
+class FloatKey(AnimKey):
+    # int32 frame, float32 value
+    dtype = np.dtype([("frame", "<i4"), ("value", "<f4")])
+
+
+class Actor:
+    __slots__ = ("mesh_hash", "name", "position", "rotation", "scale")
+
+    def __init__(self, mesh_hash, name, position, rotation, scale):
+        self.mesh_hash = mesh_hash
+        self.name = name
+        self.position = position
+        self.rotation = rotation
+        self.scale = scale
+
+    @classmethod
+    def read(cls, ar: FArchiveReader, scale):
+        mesh_hash = ar.read_int()
+        name = ar.read_fstring()
+        transform = ar.read_float_array(9)
+        return cls(mesh_hash, name, transform[:3] * np.float32(scale), transform[3:6], transform[6:])
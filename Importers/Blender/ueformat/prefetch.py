@@ -0,0 +1,127 @@
+import os
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+from .decoder import STATIC_MESH_SECTIONS, read_uemodel_file
+
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_PENDING = 32
+DEFAULT_MAX_MEMORY = 1024 ** 3
+# what a mesh still being decoded counts for, the real size is only known once it is done
+# a guess instead of a stat of the file so the main thread never waits on the disk to queue one
+ESTIMATED_SIZE = 16 * 1024 ** 2
+
+
+def get_decoded_size(decoded):
+    if decoded is None:
+        return 0
+    _, data = decoded
+    arrays = [data.vertices, data.indices, data.normals, *data.uvs, *[color.data for color in data.colors]]
+    return sum(getattr(array, "nbytes", 0) for array in arrays)
+
+
+class MeshPrefetcher:
+    # reads, decompresses and decodes the next .uemodel files on worker threads while the main thread builds meshes
+    # zstd, zlib and numpy release the GIL so this overlaps most of the decode time with bpy work
+    # at most max_pending files are in flight and decoded results waiting to be built stay under max_memory
+    # paths can be given up front or added while the caller goes through the map
+
+    def __init__(self, paths=(), scale_factor=0.01, sections=STATIC_MESH_SECTIONS, cache=None, profiler=None,
+                 workers=DEFAULT_WORKERS, max_pending=DEFAULT_MAX_PENDING, max_memory=DEFAULT_MAX_MEMORY):
+        self.scale_factor = scale_factor
+        self.sections = sections
+        self.cache = cache if cache is not None and cache.accepts(scale_factor, sections) else None
+        self.profiler = profiler # ImportProfiler sampling the decodes on the worker threads
+        self.max_pending = max_pending
+        self.max_memory = max_memory
+
+        self.order = {} # unique paths, in the order they are built
+        self.queue = deque()
+        self.pending = {} # path -> (future, estimated size)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="uemodel_prefetch")
+        for path in paths:
+            self.add(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def decode(self, path):
+        with self.profiler.profile_decode(path) if self.profiler else nullcontext():
+            return self.decode_file(path)
+
+    def decode_file(self, path):
+        if self.cache is not None:
+            cached = self.cache.load(path, self.scale_factor, self.sections)
+            if cached is not None:
+                return cached
+
+        if not os.path.exists(path):
+            return
+        decoded = read_uemodel_file(path, self.scale_factor, self.sections)
+        if decoded is not None and self.cache is not None:
+            self.cache.store(path, self.scale_factor, self.sections, *decoded)
+        return decoded
+
+    def add(self, path):
+        if path in self.order:
+            return
+        self.order[path] = len(self.order)
+        self.queue.append(path)
+        self.fill()
+
+    def used_memory(self):
+        used = 0
+        for future, estimate in self.pending.values():
+            if future.done() and future.exception() is None:
+                used += get_decoded_size(future.result())
+            else:
+                used += estimate
+        return used
+
+    def fill(self):
+        used = self.used_memory()
+        while self.queue and len(self.pending) < self.max_pending:
+            if self.pending and used + ESTIMATED_SIZE > self.max_memory:
+                break
+
+            path = self.queue.popleft()
+            self.pending[path] = (self.executor.submit(self.decode, path), ESTIMATED_SIZE)
+            used += ESTIMATED_SIZE
+
+    def take(self, path):
+        # (object_name, UEModel) decoded ahead of time, None if the path was never queued or failed to decode
+        index = self.order.get(path)
+        if index is None:
+            return
+
+        # meshes queued before this one were skipped by the caller, free their slots
+        for skipped in [queued for queued in self.pending if self.order[queued] < index]:
+            self.pending.pop(skipped)[0].cancel()
+
+        pending = self.pending.pop(path, None)
+        if pending is None:
+            # reached before it was submitted, the caller imports it itself
+            while self.queue and self.order[self.queue[0]] <= index:
+                self.queue.popleft()
+            self.fill()
+            return
+
+        future, _ = pending
+        try:
+            decoded = future.result()
+        except Exception as e:
+            print("WARNING: Prefetching", path, "failed:", e)
+            decoded = None
+        self.fill()
+        return decoded
+
+    def close(self):
+        self.queue.clear()
+        for future, _ in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,112 @@
+import io
+import os
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+
+# sort keys of the text report, the .prof file keeps everything for snakeviz/pstats
+REPORT_SORT_KEYS = ("cumulative", "tottime")
+REPORT_LINES = 60
+
+
+class ImportProfiler:
+    # profiles a sample of the imported files and adds them all up into one report
+    # every_nth profiles file 1, 1 + n, 1 + 2n, ..., min_size profiles every file of at least that many bytes
+    # cProfile only sees the thread it runs on, so decodes on prefetch threads are sampled by profile_decode
+    # with their own counter, and their stats are added to the same report under lock
+
+    def __init__(self, every_nth=0, min_size=0):
+        self.every_nth = every_nth
+        self.min_size = min_size
+        self.file_count = 0
+        self.profiled_count = 0
+        self.profiled_paths = []
+        self.decode_count = 0
+        self.profiled_decode_count = 0
+        self.stats = None
+        self.lock = threading.Lock()
+
+    def __bool__(self):
+        return self.every_nth > 0 or self.min_size > 0
+
+    def should_profile(self, index, path):
+        if self.every_nth > 0 and index % self.every_nth == 0:
+            return True
+        if self.min_size > 0 and path is not None:
+            try:
+                return os.path.getsize(path) >= self.min_size
+            except OSError:
+                return False
+        return False
+
+    @contextmanager
+    def profile(self, path=None):
+        # the import of a file on the main thread, and its decode when it wasn't prefetched
+        with self.lock:
+            index = self.file_count
+            self.file_count += 1
+        if not self.should_profile(index, path):
+            yield
+            return
+
+        with self.collect():
+            yield
+        with self.lock:
+            self.profiled_count += 1
+            self.profiled_paths.append(path)
+
+    @contextmanager
+    def profile_decode(self, path):
+        # the read, decompression and parsing of a file on a prefetch thread
+        with self.lock:
+            index = self.decode_count
+            self.decode_count += 1
+        if not self.should_profile(index, path):
+            yield
+            return
+
+        with self.collect():
+            yield
+        with self.lock:
+            self.profiled_decode_count += 1
+
+    @contextmanager
+    def collect(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            stats = pstats.Stats(profile)
+            with self.lock:
+                if self.stats is None:
+                    self.stats = stats
+                else:
+                    self.stats.add(stats)
+
+    def write_report(self, directory, name):
+        # <name>.prof with the raw aggregated stats and <name>.txt sorted by cumulative and own time
+        if self.stats is None:
+            return
+
+        prof_path = os.path.join(directory, name + ".prof")
+        self.stats.dump_stats(prof_path)
+
+        report = io.StringIO()
+        report.write(f"{self.profiled_count} of {self.file_count} files profiled\n")
+        report.write(f"{self.profiled_decode_count} of {self.decode_count} prefetched decodes profiled\n")
+        self.stats.stream = report
+        for sort_key in REPORT_SORT_KEYS:
+            report.write(f"\n---------- sorted by {sort_key} ----------\n")
+            self.stats.sort_stats(sort_key).print_stats(REPORT_LINES)
+
+        report.write("\n---------- profiled files ----------\n")
+        for path in self.profiled_paths:
+            report.write(f"{path}\n")
+
+        text_path = os.path.join(directory, name + ".txt")
+        with open(text_path, 'w') as file:
+            file.write(report.getvalue())
+        return prof_path, text_path
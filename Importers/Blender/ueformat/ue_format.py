@@ -1,16 +1,17 @@
-import io
 import os
-import gzip
-import struct
+import hashlib
 import numpy as np
-import zstandard as zstd
-from enum import IntEnum, auto
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
 import bpy
 import bpy_extras
 from bpy.props import StringProperty, BoolProperty, PointerProperty, FloatProperty, CollectionProperty
 from bpy.types import Scene
-from mathutils import Vector, Matrix, Quaternion
+from mathutils import Matrix
+
+from .decoder import Log, MODEL_IDENTIFIER, ANIM_IDENTIFIER, read_data, read_file, UEModel, UEAnim
 
 # ---------- ADDON ---------- #
 
@@ -82,6 +83,7 @@ class UFImportUEModel(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
             UEFormatImport(UEModelOptions(scale_factor=bpy.context.scene.uf_settings.scale,
                                           bone_length=bpy.context.scene.uf_settings.bone_length,
                                           reorient_bones=bpy.context.scene.uf_settings.reorient_bones)).import_file(os.path.join(self.directory, file.name))
+        clear_loop_vertex_indices()
         return {'FINISHED'}
 
     def draw(self, context):
@@ -100,8 +102,10 @@ class UFImportUEAnim(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
     directory: StringProperty(subtype='DIR_PATH')
 
     def execute(self, context):
-        for file in self.files:
-            UEFormatImport().import_file(os.path.join(self.directory, file.name))
+        importer = UEFormatImport(UEAnimOptions(scale_factor=bpy.context.scene.uf_settings.scale,
+                                                rotation_only=bpy.context.scene.uf_settings.rotation_only))
+        importer.import_files([os.path.join(self.directory, file.name) for file in self.files])
+        clear_loop_vertex_indices()
         return {'FINISHED'}
 
     def draw(self, context):
@@ -125,14 +129,6 @@ operators = [UEFORMAT_PT_Panel, UFImportUEModel, UFImportUEAnim, UFSettings]
 
 
 def register():
-    global zstd_decompresser
-    zstd_decompresser = zstd.ZstdDecompressor()
-
-    # if used as script decomresser can be initialized like this
-    # from . import ue_format
-    # ue_format.zstd_decompresser = zstd.ZstdDecompressor()
-
-
     for operator in operators:
         bpy.utils.register_class(operator)
 
@@ -147,9 +143,6 @@ def unregister():
     del Scene.uf_settings
     bpy.types.TOPBAR_MT_file_import.remove(draw_import_menu)
 
-    global zstd_decompresser
-    del zstd_decompresser
-
 
 if __name__ == "__main__":
     register()
@@ -157,14 +150,130 @@ if __name__ == "__main__":
 
 # ---------- IMPORT CLASSES ---------- #
 
-def bytes_to_str(in_bytes):
-    return in_bytes.rstrip(b'\x00').decode()
+# corner -> vertex index arrays keyed by mesh session_uid, shared by uv layers, color layers and overrides
+loop_vertex_indices = {}
+
+
+def get_loop_vertex_indices(mesh):
+    indices = loop_vertex_indices.get(mesh.session_uid)
+    if indices is None or len(indices) != len(mesh.loops):
+        indices = np.empty(len(mesh.loops), dtype=np.int32)
+        mesh.loops.foreach_get("vertex_index", indices)
+        loop_vertex_indices[mesh.session_uid] = indices
+    return indices
+
+
+def share_loop_vertex_indices(source, target):
+    # copies of a mesh have the same topology, reuse the array instead of reading it again
+    indices = loop_vertex_indices.get(source.session_uid)
+    if indices is not None:
+        loop_vertex_indices[target.session_uid] = indices
+
+
+def clear_loop_vertex_indices():
+    loop_vertex_indices.clear()
+
+
+def multiply_quats(a, b):
+    # hamilton product of wxyz quaternions, broadcasts over leading axes
+    aw, ax, ay, az = np.moveaxis(np.asarray(a), -1, 0)
+    bw, bx, by, bz = np.moveaxis(np.asarray(b), -1, 0)
+    return np.stack((aw * bw - ax * bx - ay * by - az * bz,
+                     aw * bx + ax * bw + ay * bz - az * by,
+                     aw * by - ax * bz + ay * bw + az * bx,
+                     aw * bz + ax * by - ay * bx + az * bw), axis=-1)
+
+
+def get_transform_matrices(positions, rotations):
+    # 4x4 matrices from translations and XYZW quaternions, one per row
+    norms = np.linalg.norm(rotations, axis=-1, keepdims=True)
+    x, y, z, w = np.moveaxis(np.divide(rotations, norms, out=np.zeros_like(rotations), where=norms > 0), -1, 0)
+
+    matrices = np.zeros((len(positions), 4, 4), dtype=np.float64)
+    matrices[:, 0, 0] = 1 - 2 * (y * y + z * z)
+    matrices[:, 0, 1] = 2 * (x * y - z * w)
+    matrices[:, 0, 2] = 2 * (x * z + y * w)
+    matrices[:, 1, 0] = 2 * (x * y + z * w)
+    matrices[:, 1, 1] = 1 - 2 * (x * x + z * z)
+    matrices[:, 1, 2] = 2 * (y * z - x * w)
+    matrices[:, 2, 0] = 2 * (x * z - y * w)
+    matrices[:, 2, 1] = 2 * (y * z + x * w)
+    matrices[:, 2, 2] = 1 - 2 * (x * x + y * y)
+    matrices[:, :3, 3] = positions
+    matrices[:, 3, 3] = 1
+    return matrices
+
+
+def get_world_matrices(local_matrices, parents):
+    # parent @ local down every chain, all bones of one depth are composed with a single matmul
+    count = len(parents)
+    parents = np.where((parents >= 0) & (parents < count), parents, -1)
+    depths = np.zeros(count, dtype=np.int32)
+    for index in range(count):
+        parent = parents[index]
+        while parent >= 0 and depths[index] <= count: # bounded in case of a cycle
+            depths[index] += 1
+            parent = parents[parent]
+
+    world_matrices = local_matrices.copy()
+    for depth in range(1, depths.max(initial=0) + 1):
+        level = np.flatnonzero(depths == depth)
+        world_matrices[level] = world_matrices[parents[level]] @ local_matrices[level]
+    return world_matrices
+
+
+# armatures of already built skeletons by get_skeleton_hash, identical skeletons share one
+skeletons = {}
+SKELETON_HASH_PROPERTY = "uf_skeleton_hash"
+
+
+def get_skeleton_hash(data, bone_length):
+    skeleton_hash = hashlib.sha1()
+    skeleton_hash.update(repr(bone_length).encode())
+    for bone in data.bones:
+        skeleton_hash.update(f"{bone.name}\0{bone.parent_index}\0".encode())
+        skeleton_hash.update(np.asarray(bone.position, dtype=np.float32).tobytes())
+        skeleton_hash.update(np.asarray(bone.rotation, dtype=np.float32).tobytes())
+    for socket in data.sockets:
+        skeleton_hash.update(f"{socket.name}\0{socket.parent_name}\0".encode())
+        skeleton_hash.update(np.asarray(socket.position, dtype=np.float32).tobytes())
+        skeleton_hash.update(np.asarray(socket.rotation, dtype=np.float32).tobytes())
+    return skeleton_hash.hexdigest()
+
+
+def get_cached_skeleton(skeleton_hash):
+    armature_name = skeletons.get(skeleton_hash)
+    armature_data = bpy.data.armatures.get(armature_name) if armature_name else None
+    # the datablock may have been renamed or removed since
+    if armature_data is None or armature_data.get(SKELETON_HASH_PROPERTY) != skeleton_hash:
+        skeletons.pop(skeleton_hash, None)
+        return
+    return armature_data
+
 
+# LINEAR in the keyframe interpolation enum, foreach_set takes the enum value
+KEYFRAME_INTERPOLATION_LINEAR = 1
 
-def get_case_insensitive(source, string):
-    for item in source:
-        if item.name.lower() == string.lower():
-            return item
+
+def create_fcurves(action, data_path, frames, values, columns):
+    # one f-curve per column of values, keys filled with foreach_set instead of per key co/interpolation
+    key_count = len(frames)
+    curves = [action.fcurves.new(data_path, index=index) for index in range(columns)]
+    if key_count == 0: # tracks and curves without keys still get their empty f-curves
+        return curves
+
+    values = np.asarray(values, dtype=np.float32).reshape(key_count, columns)
+    coords = np.empty((key_count, 2), dtype=np.float32)
+    coords[:, 0] = frames
+    interpolation = np.full(key_count, KEYFRAME_INTERPOLATION_LINEAR, dtype=np.int32)
+
+    for index, curve in enumerate(curves):
+        curve.keyframe_points.add(key_count)
+        coords[:, 1] = values[:, index]
+        curve.keyframe_points.foreach_set("co", coords.ravel())
+        curve.keyframe_points.foreach_set("interpolation", interpolation)
+        curve.update()
+    return curves
 
 
 def get_active_armature():
@@ -180,263 +289,148 @@ def get_active_armature():
                 return modifier.object
 
 
-class Log:
-    INFO = u"\u001b[36m"
-    ERROR = u"\u001b[33m"
-    RESET = u"\u001b[0m"
-
-    NoLog = False
-
-    @staticmethod
-    def info(message):
-        if Log.NoLog: return
-        print(f"{Log.INFO}[UEFORMAT] {Log.RESET}{message}")
-
-    @staticmethod
-    def error(message):
-        if Log.NoLog: return
-        print(f"{Log.ERROR}[UEFORMAT] {Log.RESET}{message}")
-
-    timers = {}
-
-    @staticmethod
-    def time_start(name):
-        if Log.NoLog: return
-        Log.timers[name] = time.time()
-    
-    @staticmethod
-    def time_end(name):
-        if Log.NoLog: return
-        if name in Log.timers:
-            Log.info(f"{name} took {time.time() - Log.timers[name]} seconds")
-            del Log.timers[name]
-        else:
-            Log.error(f"Timer {name} does not exist")
-
-# TODO: optimize and clean up code
-class FArchiveReader:
-    data = None
-    size = 0
-
-    def __init__(self, data):
-        self.data = io.BytesIO(data)
-        self.size = len(data)
-        self.data.seek(0)
-
-    def __enter__(self):
-        # self.size = len(self.data.read())
-        self.data.seek(0)
-        return self
-
-    def __exit__(self, type, value, traceback):
-        self.data.close()
-
-    def eof(self):
-        return self.data.tell() >= self.size
-
-    def read(self, size: int):
-        return self.data.read(size)
-
-    def read_to_end(self):
-        return self.data.read(self.size - self.data.tell())
-
-    def read_bool(self):
-        return struct.unpack("?", self.data.read(1))[0]
-
-    def read_string(self, size: int):
-        string = self.data.read(size)
-        return bytes_to_str(string)
+def get_shape_key_blocks(armature):
+    # case folded shape key name -> (Key, key block name) over the meshes deformed by the armature
+    key_blocks = {}
+    for obj in bpy.data.objects:
+        if obj.type != "MESH" or obj.data.shape_keys is None:
+            continue
+        if obj.parent != armature and not any(modifier.type == "ARMATURE" and modifier.object == armature for modifier in obj.modifiers):
+            continue
 
-    def read_fstring(self):
-        size, = struct.unpack("i", self.data.read(4))
-        string = self.data.read(size)
-        return bytes_to_str(string)
+        shape_keys = obj.data.shape_keys
+        for key_block in shape_keys.key_blocks:
+            key_blocks.setdefault(key_block.name.casefold(), (shape_keys, key_block.name))
+    return key_blocks
 
-    def read_int(self):
-        return struct.unpack("i", self.data.read(4))[0]
 
-    def read_int_vector(self, size: int):
-        return struct.unpack(str(size) + "I", self.data.read(size * 4))
 
-    def read_short(self):
-        return struct.unpack("h", self.data.read(2))[0]
+# worker threads decoding files for UEFormatImport.import_files
+IMPORT_THREADS = 4
 
-    def read_byte(self):
-        return struct.unpack("c", self.data.read(1))[0]
-
-    def read_float(self):
-        return struct.unpack("f", self.data.read(4))[0]
-
-    def read_float_vector(self, size: int):
-        return struct.unpack(str(size) + "f", self.data.read(size * 4))
-
-    def read_byte_vector(self, size: int):
-        return struct.unpack(str(size) + "B", self.data.read(size))
-
-    def skip(self, size: int):
-        self.data.seek(size, 1)
-
-    def read_bulk_array(self, predicate):
-        count = self.read_int()
-        return self.read_array(count, predicate)
-
-    def read_array(self, count, predicate):
-        array = []
-        for counter in range(count):
-            array.append(predicate(self))
-        return array
-
-
-MAGIC = "UEFORMAT"
-MODEL_IDENTIFIER = "UEMODEL"
-ANIM_IDENTIFIER = "UEANIM"
-
-class EUEFormatVersion(IntEnum):
-    BeforeCustomVersionWasAdded = 0
-    SerializeBinormalSign = 1
-    AddMultipleVertexColors = 2
-
-    VersionPlusOne = auto()
-    LatestVersion = VersionPlusOne - 1
 
 class UEFormatOptions:
-    pass
+    scale_factor = 0.01
+    sections = None
+    report_memory = False # log peak traced memory per file, slows down the import
+    cache = None # MeshCache decoded models are loaded from and stored to
+    profiler = None # profiling.ImportProfiler sampling the imported files
 
 class UEModelOptions(UEFormatOptions):
 
-    def __init__(self, link=True, scale_factor=0.01, bone_length=4.0, reorient_bones=False):
+    def __init__(self, link=True, scale_factor=0.01, bone_length=4.0, reorient_bones=False, report_memory=False, fast_mesh_build=True, sections=None, cache=None, reuse_skeletons=True, profiler=None):
         self.scale_factor = scale_factor
         self.bone_length = bone_length
         self.reorient_bones = reorient_bones
         self.link = link
+        self.report_memory = report_memory
+        self.fast_mesh_build = fast_mesh_build # fill the mesh with foreach_set instead of from_pydata
+        self.sections = sections # names of the sections to decode, None decodes all of them
+        self.cache = cache
+        self.reuse_skeletons = reuse_skeletons # meshes with identical skeletons share one armature
+        self.profiler = profiler
 
 
 class UEAnimOptions(UEFormatOptions):
 
-    def __init__(self, link=True, override_skeleton=None, scale_factor=0.01, rotation_only=False):
+    def __init__(self, link=True, override_skeleton=None, scale_factor=0.01, rotation_only=False, report_memory=False):
         self.override_skeleton = override_skeleton
         self.scale_factor = scale_factor
         self.rotation_only = rotation_only
         self.link = link
+        self.report_memory = report_memory
 
 class UEFormatImport:
 
     def __init__(self, options=UEFormatOptions()):
         self.options = options
+        self.bone_indices = {} # armature session_uid -> case folded bone name -> pose bone
+        self.shape_key_blocks = {} # armature session_uid -> get_shape_key_blocks
+        self.shape_key_actions = {} # armature action -> shape key actions made with it, to assign them when link is off
 
-    def import_file(self, path: str):
+    def import_file(self, path: str, decoded=None):
+        # decoded is the (identifier, object_name, data) of the file when it was decoded ahead of time
         Log.time_start(f"Import {path}")
-        with open(path, 'rb') as file:
-            obj = self.import_data(file.read())
+        if self.options.report_memory:
+            Log.memory_start(f"Import {path}")
+
+        with self.options.profiler.profile(path) if self.options.profiler else nullcontext():
+            obj = self.import_decoded(decoded if decoded is not None else self.decode_file(path))
+
+        if self.options.report_memory:
+            Log.memory_end(f"Import {path}")
         Log.time_end(f"Import {path}")
         return obj
 
-    def import_data(self, data):
-        with FArchiveReader(data) as ar:
-            magic = ar.read_string(len(MAGIC))
-            if magic != MAGIC:
-                return
-
-            identifier = ar.read_fstring()
-            self.file_version = EUEFormatVersion(int.from_bytes(ar.read_byte(), byteorder="big"))
-            if self.file_version > EUEFormatVersion.LatestVersion:
-                Log.error(f"File Version {self.file_version} is not supported for this version of the importer.")
-                return
-            object_name = ar.read_fstring()
-            Log.info(f"Importing {object_name}")
-
-            read_archive = ar
-            is_compressed = ar.read_bool()
-            if is_compressed:
-                compression_type = ar.read_fstring()
-                uncompressed_size = ar.read_int()
-                compressed_size = ar.read_int()
-
-                if compression_type == "GZIP":
-                    read_archive = FArchiveReader(gzip.decompress(ar.read_to_end()))
-                elif compression_type == "ZSTD":
-                    read_archive = FArchiveReader(zstd_decompresser.decompress(ar.read_to_end(), uncompressed_size))
-                else:
-                    Log.info(f"Unknown Compression Type: {compression_type}")
-                    return
-
-            if identifier == MODEL_IDENTIFIER:
-                if 0:
-                    import cProfile, pstats, io
-                    from pstats import SortKey
-                    pr = cProfile.Profile()
-                    pr.enable()
-                    obj = self.import_uemodel_data(read_archive, object_name)
-                    pr.disable()
-                    s = io.StringIO()
-                    sortby = SortKey.TIME
-                    ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
-                    ps.print_stats()
-                    print(s.getvalue())
-                    return obj
-                else:
-                    return self.import_uemodel_data(read_archive, object_name)
-            
-            elif identifier == ANIM_IDENTIFIER:
-                return self.import_ueanim_data(read_archive, object_name)
-
-    def import_uemodel_data(self, ar: FArchiveReader, name: str):
-        data = UEModel()
-
-        while not ar.eof():
-            header_name = ar.read_fstring()
-            array_size = ar.read_int()
-            byte_size = ar.read_int()
-
-            pos = ar.data.tell()
-            if header_name == "VERTICES":
-                flattened = ar.read_float_vector(array_size * 3)
-                data.vertices = (np.array(flattened) * self.options.scale_factor).reshape(array_size, 3)
-
-            elif header_name == "INDICES":
-                data.indices = np.array(ar.read_int_vector(array_size), dtype=np.int32).reshape(array_size // 3, 3)
-            elif header_name == "NORMALS":
-                if self.file_version >= EUEFormatVersion.SerializeBinormalSign:
-                    flattened = np.array(ar.read_float_vector(array_size * 4)) # W XYZ # TODO: change to XYZ W
-                    data.normals = flattened.reshape(-1,4)[:,1:]
-                else:
-                    flattened = np.array(ar.read_float_vector(array_size * 3)).reshape(array_size, 3)
-                    data.normals = flattened
-            elif header_name == "TANGENTS":
-                ar.skip(array_size * 3 * 3)
-                # flattened = np.array(ar.read_float_vector(array_size * 3)).reshape(array_size, 3)
-            elif header_name == "VERTEXCOLORS":
-                if self.file_version >= EUEFormatVersion.AddMultipleVertexColors:
-                    data.colors = []
-                    for i in range(array_size):
-                        data.colors.append(VertexColor.read(ar))
-                else:
-                    count = ar.read_int()
-                    data.colors = [VertexColor("COL0", np.array(ar.read_byte_vector(count * 4)).reshape(count, 4))]
-            elif header_name == "TEXCOORDS":
-                data.uvs = []
-                for i in range(array_size):
-                    count = ar.read_int()
-                    data.uvs.append(np.array(ar.read_float_vector(count * 2)).reshape(count, 2))
-            elif header_name == "MATERIALS":
-                data.materials = ar.read_array(array_size, lambda ar: Material(ar))
-            elif header_name == "WEIGHTS":
-                data.weights = ar.read_array(array_size, lambda ar: Weight(ar))
-            elif header_name == "BONES":
-                data.bones = ar.read_array(array_size, lambda ar: Bone(ar, self.options.scale_factor))
-            elif header_name == "MORPHTARGETS":
-                data.morphs = ar.read_array(array_size, lambda ar: MorphTarget(ar, self.options.scale_factor))
-            elif header_name == "SOCKETS":
-                data.sockets = ar.read_array(array_size, lambda ar: Socket(ar, self.options.scale_factor))
-            else:
-                ar.skip(byte_size)
-            ar.data.seek(pos + byte_size, 0)
+    def import_files(self, paths, threads=IMPORT_THREADS):
+        # files are decoded on worker threads a few ahead of the main thread, which only creates the datablocks
+        # the importer is shared so bone and shape key lookups are built once per armature, not once per file
+        Log.time_start(f"Import {len(paths)} files")
+        objects = []
+        with ThreadPoolExecutor(threads) as executor:
+            pending = deque()
+            for path in paths:
+                pending.append(executor.submit(self.decode_file, path))
+                if len(pending) > threads * 2:
+                    objects.append(self.import_decoded(pending.popleft().result()))
+            while pending:
+                objects.append(self.import_decoded(pending.popleft().result()))
+        Log.time_end(f"Import {len(paths)} files")
+        return objects
+
+    def use_cache(self):
+        return self.options.cache is not None and self.options.cache.accepts(self.options.scale_factor, self.options.sections)
+
+    def decode_file(self, path: str):
+        # (identifier, object_name, data), doesn't touch Blender data so it can run on any thread
+        if self.use_cache():
+            cached = self.options.cache.load(path, self.options.scale_factor, self.options.sections)
+            if cached is not None:
+                return (MODEL_IDENTIFIER, *cached)
+
+        decoded = read_file(path, self.options.scale_factor, self.options.sections)
+        if decoded is not None and decoded[0] == MODEL_IDENTIFIER and self.use_cache():
+            self.options.cache.store(path, self.options.scale_factor, self.options.sections, decoded[1], decoded[2])
+        return decoded
 
+    def import_data(self, data):
+        return self.import_decoded(read_data(data, self.options.scale_factor, self.options.sections))
+
+    def import_decoded(self, decoded):
+        if decoded is None:
+            return
+        identifier, object_name, data = decoded
+        Log.info(f"Importing {object_name}")
+
+        if identifier == MODEL_IDENTIFIER:
+            return self.import_uemodel(data, object_name)
+
+        elif identifier == ANIM_IDENTIFIER:
+            return self.import_ueanim(data, object_name)
+
+    def get_bone_index(self, armature):
+        index = self.bone_indices.get(armature.session_uid)
+        if index is None:
+            index = self.bone_indices[armature.session_uid] = {}
+            for bone in armature.pose.bones:
+                index.setdefault(bone.name.casefold(), bone) # the first bone with a name wins when several differ only in case
+        return index
+
+    def get_shape_key_blocks(self, armature):
+        key_blocks = self.shape_key_blocks.get(armature.session_uid)
+        if key_blocks is None:
+            key_blocks = self.shape_key_blocks[armature.session_uid] = get_shape_key_blocks(armature)
+        return key_blocks
+
+    def import_uemodel(self, data: UEModel, name: str):
         # geometry
         has_geometry = len(data.vertices) > 0 and len(data.indices) > 0
         if has_geometry:
             mesh_data = bpy.data.meshes.new(name)
-            mesh_data.from_pydata(data.vertices, [], data.indices)
+            if self.options.fast_mesh_build:
+                self.build_mesh_geometry(mesh_data, data)
+            else:
+                mesh_data.from_pydata(data.vertices, [], data.indices)
     
             mesh_object = bpy.data.objects.new(name, mesh_data)
             return_object = mesh_object
@@ -445,19 +439,37 @@ class UEFormatImport:
     
             # normals
             if len(data.normals) > 0:
-                mesh_data.polygons.foreach_set("use_smooth", [True] * len(mesh_data.polygons))
+                mesh_data.polygons.foreach_set("use_smooth", np.ones(len(mesh_data.polygons), dtype=bool))
                 mesh_data.normals_split_custom_set_from_vertices(data.normals)
                 if bpy.app.version < (4, 1, 0):
                     mesh_data.use_auto_smooth = True
 
             # weights
             if len(data.weights) > 0 and len(data.bones) > 0:
-                for weight in data.weights:
-                    bone_name = data.bones[weight.bone_index].name
+                bone_indices = data.weights["bone_index"]
+                weight_values = data.weights["weight"]
+
+                # create the groups in the order the bones first appear in, like adding them one weight at a time did
+                used_bones, first_seen = np.unique(bone_indices, return_index=True)
+                vertex_groups = {}
+                for bone_index in used_bones[np.argsort(first_seen)].tolist():
+                    bone_name = data.bones[bone_index].name
                     vertex_group = mesh_object.vertex_groups.get(bone_name)
                     if not vertex_group:
                         vertex_group = mesh_object.vertex_groups.new(name=bone_name)
-                    vertex_group.add([weight.vertex_index], weight.weight, 'ADD')
+                    vertex_groups[bone_index] = vertex_group
+
+                # one add() per bone and distinct weight value instead of one per influence
+                order = np.lexsort((weight_values, bone_indices))
+                bone_indices = bone_indices[order]
+                weight_values = weight_values[order]
+                vertex_indices = data.weights["vertex_index"][order]
+                splits = np.flatnonzero((bone_indices[1:] != bone_indices[:-1]) | (weight_values[1:] != weight_values[:-1])) + 1
+                starts = np.concatenate(([0], splits)).tolist()
+                ends = np.concatenate((splits, [len(order)])).tolist()
+                for start, end in zip(starts, ends):
+                    vertex_group = vertex_groups[int(bone_indices[start])]
+                    vertex_group.add(vertex_indices[start:end].tolist(), float(weight_values[start]), 'ADD')
     
             # morph targets
             if len(data.morphs) > 0:
@@ -465,18 +477,24 @@ class UEFormatImport:
                 default_key.name = "Default"
                 default_key.interpolation = 'KEY_LINEAR'
     
+                base_coords = np.empty(len(mesh_data.vertices) * 3, dtype=np.float32)
+                mesh_data.vertices.foreach_get("co", base_coords)
+                base_coords = base_coords.reshape(-1, 3)
+
                 for morph in data.morphs:
                     key = mesh_object.shape_key_add(from_mix=False)
                     key.name = morph.name
                     key.interpolation = 'KEY_LINEAR'
-    
-                    for delta in morph.deltas:
-                        key.data[delta.vertex_index].co += Vector(delta.position)
+
+                    # add.at accumulates repeated vertex indices the same way += per delta did
+                    key_coords = base_coords.copy()
+                    np.add.at(key_coords, morph.vertex_indices, morph.positions)
+                    key.data.foreach_set("co", key_coords.ravel())
             
             squish = lambda array: array.reshape(array.size) # Squish nD array into 1D array (required by foreach_set).
             do_remapping = lambda array, indices: array[indices]
 
-            vertices = [vertex for polygon in mesh_data.polygons for vertex in polygon.vertices]
+            vertices = get_loop_vertex_indices(mesh_data)
             # indices = np.array([index for polygon in mesh_data.polygons for index in polygon.loop_indices], dtype=np.int32)
             # assert np.all(indices[:-1] <= indices[1:]) # check if indices are sorted hmm idk
             for color_info in data.colors:
@@ -509,21 +527,27 @@ class UEFormatImport:
 
             # materials
             if len(data.materials) > 0:
+                material_indices = np.zeros(len(mesh_data.polygons), dtype=np.int32)
                 for i, material in enumerate(data.materials):
                     mat = bpy.data.materials.get(material.material_name)
                     if mat is None:
                         mat = bpy.data.materials.new(name=material.material_name)
                     mesh_data.materials.append(mat)
-    
+
                     start_face_index = (material.first_index // 3)
                     end_face_index = start_face_index + material.num_faces
-                    for face_index in range(start_face_index, end_face_index):
-                        mesh_data.polygons[face_index].material_index = i
+                    material_indices[start_face_index:end_face_index] = i
+                mesh_data.polygons.foreach_set("material_index", material_indices)
 
         # skeleton
         if len(data.bones) > 0 or len(data.sockets) > 0:
-            armature_data = bpy.data.armatures.new(name=name)
-            armature_data.display_type = 'STICK'
+            bone_length = self.options.bone_length * self.options.scale_factor
+            skeleton_hash = get_skeleton_hash(data, bone_length)
+            armature_data = get_cached_skeleton(skeleton_hash) if self.options.reuse_skeletons else None
+            create_skeleton = armature_data is None
+            if create_skeleton:
+                armature_data = bpy.data.armatures.new(name=name)
+                armature_data.display_type = 'STICK'
 
             armature_object = bpy.data.objects.new(name + "_Skeleton", armature_data)
             armature_object.show_in_front = True
@@ -536,29 +560,16 @@ class UEFormatImport:
             if has_geometry:
                 mesh_object.parent = armature_object
 
-        if len(data.bones) > 0:
-            # create bones
-            bpy.ops.object.mode_set(mode='EDIT')
-            edit_bones = armature_data.edit_bones
-            for bone in data.bones:
-                bone_pos = Vector(bone.position)
-                bone_rot = Quaternion(
-                    (bone.rotation[3], bone.rotation[0], bone.rotation[1], bone.rotation[2]))  # xyzw -> wxyz
-
-                edit_bone = edit_bones.new(bone.name)
-                edit_bone.length = self.options.bone_length * self.options.scale_factor
-                
-                bone_matrix = Matrix.Translation(bone_pos) @ bone_rot.to_matrix().to_4x4()
-
-                if bone.parent_index >= 0:
-                    parent_bone = edit_bones.get(data.bones[bone.parent_index].name)
-                    edit_bone.parent = parent_bone
-                    bone_matrix = parent_bone.matrix @ bone_matrix
-
-                edit_bone.matrix = bone_matrix
+            if create_skeleton:
+                # bones and sockets are created in one edit mode session, with their matrices computed up front
+                bpy.ops.object.mode_set(mode='EDIT')
+                self.build_skeleton(armature_data.edit_bones, data, bone_length)
+                bpy.ops.object.mode_set(mode='OBJECT')
 
-            bpy.ops.object.mode_set(mode='OBJECT')
+                armature_data[SKELETON_HASH_PROPERTY] = skeleton_hash
+                skeletons[skeleton_hash] = armature_data.name
 
+        if len(data.bones) > 0:
             if has_geometry:
                 
                 # armature modifier
@@ -567,13 +578,16 @@ class UEFormatImport:
                 armature_modifier.use_vertex_groups = True
                 armature_modifier.object = armature_object
 
+            # bone colors, set once when the skeleton is built
+            # from 4.0 they are on the armature bones so objects reusing the armature share them and need no pose,
+            # which a new object on a cached armature only gets from a depsgraph update
+            if has_geometry and create_skeleton:
                 # https://docs.blender.org/api/4.0/change_log.html#id67
                 if bpy.app.version < (4, 0, 0):    
                     bone_group1 = armature_object.pose.bone_groups.new(name="BoneGroup1")
                     bone_group2 = armature_object.pose.bone_groups.new(name="No Children") 
 
-                # bone colors
-                for bone in armature_object.pose.bones:
+                for bone in armature_object.pose.bones if bpy.app.version < (4, 0, 0) else armature_data.bones:
                     if mesh_object.vertex_groups.get(bone.name) is None:
                         if bpy.app.version < (4, 0, 0):
                             bone.bone_group = bone_group1
@@ -587,50 +601,81 @@ class UEFormatImport:
                         else:
                             bone.color.palette = 'THEME03'
 
-        # sockets
-        if len(data.sockets) > 0:
-            # create sockets
-            bpy.ops.object.mode_set(mode='EDIT')
+        # socket colors
+        if len(data.sockets) > 0 and create_skeleton and bpy.app.version >= (4, 0, 0):
             for socket in data.sockets:
-                socket_bone = edit_bones.new(socket.name)
-                parent_bone = get_case_insensitive(edit_bones, socket.parent_name)
-                if parent_bone is None:
-                    continue
-                socket_bone.parent = parent_bone
-                socket_bone.length = self.options.bone_length * self.options.scale_factor
-                socket_bone.matrix = parent_bone.matrix @ Matrix.Translation(socket.position) @ Quaternion((socket.rotation[3],socket.rotation[0],socket.rotation[1],socket.rotation[2])).to_matrix().to_4x4()  # xyzw -> wxyz
-
-            bpy.ops.object.mode_set(mode='OBJECT')
-
-            # socket colors
-            for socket in data.sockets:
-                socket_bone = armature_object.pose.bones.get(socket.name)
+                socket_bone = armature_data.bones.get(socket.name)
                 if socket_bone is not None:
                     socket_bone.color.palette = 'THEME05'
 
-        if len(data.bones) > 0 or len(data.sockets) > 0 and not self.options.link: # ask to be linked for mode_set(mode='EDIT')
+        if (len(data.bones) > 0 or len(data.sockets) > 0) and not self.options.link: # ask to be linked for mode_set(mode='EDIT')
             bpy.context.collection.objects.unlink(armature_object)
 
         return return_object
 
-    def import_ueanim_data(self, ar: FArchiveReader, name: str):
-        data = UEAnim()
+    @staticmethod
+    def build_skeleton(edit_bones, data, bone_length):
+        # armature space matrices for every bone are composed in numpy, edit bones are only assigned them
+        parents = np.array([bone.parent_index for bone in data.bones], dtype=np.int32)
+        positions = np.array([bone.position for bone in data.bones], dtype=np.float64).reshape(-1, 3)
+        rotations = np.array([bone.rotation for bone in data.bones], dtype=np.float64).reshape(-1, 4)
+        bone_matrices = get_world_matrices(get_transform_matrices(positions, rotations), parents)
+
+        created = []
+        for bone, bone_matrix in zip(data.bones, bone_matrices):
+            edit_bone = edit_bones.new(bone.name)
+            edit_bone.length = bone_length
+            edit_bone.matrix = Matrix(bone_matrix)
+            created.append(edit_bone)
+
+        for edit_bone, parent_index in zip(created, parents):
+            if 0 <= parent_index < len(created):
+                edit_bone.parent = created[parent_index]
+
+        # sockets hang off bones (or earlier sockets) by case insensitive name
+        targets = {}
+        for edit_bone, bone_matrix in zip(created, bone_matrices):
+            targets.setdefault(edit_bone.name.casefold(), (edit_bone, bone_matrix))
+
+        for socket in data.sockets:
+            socket_bone = edit_bones.new(socket.name)
+            parent = targets.get(socket.parent_name.casefold())
+            if parent is None:
+                continue
+            parent_bone, parent_matrix = parent
+            socket_matrix = parent_matrix @ get_transform_matrices(np.array([socket.position], dtype=np.float64), np.array([socket.rotation], dtype=np.float64))[0]
+
+            socket_bone.parent = parent_bone
+            socket_bone.length = bone_length
+            socket_bone.matrix = Matrix(socket_matrix)
+            targets.setdefault(socket_bone.name.casefold(), (socket_bone, socket_matrix))
 
-        data.num_frames = ar.read_int()
-        data.frames_per_second = ar.read_float()
+    @staticmethod
+    def build_mesh_geometry(mesh_data, data):
+        # same result as from_pydata for a triangle list, written straight from the decoded buffers
+        corners = data.indices.ravel()
+        num_faces = len(data.indices)
 
-        while not ar.eof():
-            header_name = ar.read_fstring()
-            array_size = ar.read_int()
-            byte_size = ar.read_int()
+        mesh_data.vertices.add(len(data.vertices))
+        mesh_data.vertices.foreach_set("co", data.vertices.ravel())
 
-            if header_name == "TRACKS":
-                data.tracks = ar.read_array(array_size, lambda ar: Track(ar, self.options.scale_factor))
-            elif header_name == "CURVES":
-                data.curves = ar.read_array(array_size, lambda ar: Curve(ar))
-            else:
-                ar.skip(byte_size)
+        mesh_data.loops.add(len(corners))
+        mesh_data.loops.foreach_set("vertex_index", corners)
+
+        mesh_data.polygons.add(num_faces)
+        mesh_data.polygons.foreach_set("loop_start", np.arange(0, len(corners), 3, dtype=np.int32))
+        if not bpy.types.MeshPolygon.bl_rna.properties["loop_total"].is_readonly: # read-only once face sizes are derived from loop_start
+            mesh_data.polygons.foreach_set("loop_total", np.full(num_faces, 3, dtype=np.int32))
+
+        if len(data.normals) == 0:
+            # faces added this way are smooth from 4.1, from_pydata shades them flat unless normals make them smooth
+            mesh_data.polygons.foreach_set("use_smooth", np.zeros(num_faces, dtype=bool))
 
+        mesh_data.update(calc_edges=True)
+        # a copy, corners can be a view into a cached file that would otherwise stay mapped
+        loop_vertex_indices[mesh_data.session_uid] = corners.copy()
+
+    def import_ueanim(self, data: UEAnim, name: str):
         action = bpy.data.actions.new(name=name)
 
         armature = self.options.override_skeleton or get_active_armature()
@@ -639,229 +684,55 @@ class UEFormatImport:
             armature.animation_data.action = action
 
         # bone anim data
-        pose_bones = armature.pose.bones
+        # keys are converted to bone space for all frames at once, with the parent at rest like the per key
+        # bone.matrix assignments used to leave it, and every f-curve is filled with one foreach_set
+        bone_index = self.get_bone_index(armature)
         for track in data.tracks:
-            bone = get_case_insensitive(pose_bones, track.name)
+            bone = bone_index.get(track.name.casefold())
             if bone is None:
                 continue
 
-            def create_fcurves(name, count, key_count):
-                path = bone.path_from_id(name)
-                curves = []
-                for i in range(count):
-                    curve = action.fcurves.new(path, index=i)
-                    curve.keyframe_points.add(key_count)
-                    curves.append(curve)
-                return curves
-
-            def add_key(curves, vector, key_index, frame):
-                for i in range(len(vector)):
-                    curves[i].keyframe_points[key_index].co = frame, vector[i]
-                    curves[i].keyframe_points[key_index].interpolation = "LINEAR"
+            rest = bone.bone.matrix_local
+            parent_rest = bone.parent.bone.matrix_local if bone.parent is not None else Matrix.Identity(4)
+            # armature space -> bone space of this bone's rest pose
+            to_bone = rest.inverted() @ parent_rest
 
             if not self.options.rotation_only:
-                loc_curves = create_fcurves("location", 3, len(track.position_keys))
-                scale_curves = create_fcurves("scale", 3, len(track.scale_keys))
-                for index, key in enumerate(track.position_keys):
-                    pos = key.get_vector()
-                    if bone.parent is None:
-                        bone.matrix.translation = pos
-                    else:
-                        bone.matrix.translation = bone.parent.matrix @ pos
-                    add_key(loc_curves, bone.location, index, key.frame)
-
-                for index, key in enumerate(track.scale_keys):
-                    add_key(scale_curves, key.value, index, key.frame)
-
-            rot_curves = create_fcurves("rotation_quaternion", 4, len(track.rotation_keys))
-            for index, key in enumerate(track.rotation_keys):
-                rot = key.get_quat()
-                if bone.parent is None:
-                    bone.rotation_quaternion = rot
-                else:
-                    bone.matrix = bone.parent.matrix @ rot.to_matrix().to_4x4()
-                add_key(rot_curves, bone.rotation_quaternion, index, key.frame)
-
-            bone.matrix_basis.identity()
+                frames, positions = track.position_keys["frame"], track.position_keys["value"]
+                transform = np.array(to_bone, dtype=np.float32)
+                locations = positions @ transform[:3, :3].T + transform[:3, 3]
+                create_fcurves(action, bone.path_from_id("location"), frames, locations, 3)
+
+                create_fcurves(action, bone.path_from_id("scale"), track.scale_keys["frame"], track.scale_keys["value"], 3)
+
+            frames, rotations = track.rotation_keys["frame"], track.rotation_keys["value"][:, [3, 0, 1, 2]] # xyzw -> wxyz
+            if bone.parent is not None:
+                rotations = multiply_quats(np.array(to_bone.to_quaternion(), dtype=np.float32), rotations)
+                rotations[rotations[:, 0] < 0] *= -1 # same hemisphere Matrix.to_quaternion picks
+            create_fcurves(action, bone.path_from_id("rotation_quaternion"), frames, rotations, 4)
+
+        # curve anim data
+        # curves drive the matching shape key of the meshes using the armature, each Key gets an action of its own
+        # curves without a shape key are kept as custom properties on the armature
+        key_blocks = self.get_shape_key_blocks(armature) if len(data.curves) > 0 else {}
+        curve_actions = {}
+        for curve in data.curves:
+            frames, values = curve.keys["frame"], curve.keys["value"]
+            target = key_blocks.get(curve.name.casefold())
+            if target is None:
+                armature[curve.name] = 0.0
+                create_fcurves(action, f'["{bpy.utils.escape_identifier(curve.name)}"]', frames, values, 1)
+                continue
 
+            shape_keys, key_block_name = target
+            curve_action = curve_actions.get(shape_keys)
+            if curve_action is None:
+                curve_action = curve_actions[shape_keys] = bpy.data.actions.new(name=f"{name}_{shape_keys.user.name}")
+                if self.options.link:
+                    shape_keys.animation_data_create()
+                    shape_keys.animation_data.action = curve_action
+            create_fcurves(curve_action, f'key_blocks["{bpy.utils.escape_identifier(key_block_name)}"].value', frames, values, 1)
+
+        if curve_actions:
+            self.shape_key_actions[action] = list(curve_actions.values())
         return action
-
-
-class UEModel:
-    vertices = []
-    indices = []
-    normals = []
-    tangents = []
-    colors = []
-    uvs = []
-    materials = []
-    morphs = []
-    weights = []
-    bones = []
-    sockets = []
-
-class VertexColor:
-    name = ""
-    data = []
-
-    def __init__(self, name, data):
-        self.name = name
-        self.data = data
-
-    @classmethod
-    def read(cls, ar: FArchiveReader):
-        name = ar.read_fstring()
-        count = ar.read_int()
-        data = (np.array(ar.read_byte_vector(count * 4)).reshape(count, 4) / 255).astype(np.float32)
-
-        return cls(name, data)
-
-class Material:
-    material_name = ""
-    first_index = -1
-    num_faces = -1
-
-    def __init__(self, ar: FArchiveReader):
-        self.material_name = ar.read_fstring()
-        self.first_index = ar.read_int()
-        self.num_faces = ar.read_int()
-
-
-class Bone:
-    name = ""
-    parent_index = -1
-    position = []
-    rotation = []
-
-    def __init__(self, ar: FArchiveReader, scale):
-        self.name = ar.read_fstring()
-        self.parent_index = ar.read_int()
-        self.position = [pos * scale for pos in ar.read_float_vector(3)]
-        self.rotation = ar.read_float_vector(4)
-
-
-class Weight:
-    bone_index = -1
-    vertex_index = -1
-    weight = -1
-
-    def __init__(self, ar: FArchiveReader):
-        self.bone_index = ar.read_short()
-        self.vertex_index = ar.read_int()
-        self.weight = ar.read_float()
-
-
-class MorphTarget:
-    name = ""
-    deltas = []
-
-    def __init__(self, ar: FArchiveReader, scale):
-        self.name = ar.read_fstring()
-
-        self.deltas = ar.read_bulk_array(lambda ar: MorphTargetData(ar, scale))
-
-
-class MorphTargetData:
-    position = []
-    normals = []
-    vertex_index = -1
-
-    def __init__(self, ar: FArchiveReader, scale):
-        self.position = [pos * scale for pos in ar.read_float_vector(3)]
-        self.normals = ar.read_float_vector(3)
-        self.vertex_index = ar.read_int()
-
-
-class Socket:
-    name = ""
-    parent_name = ""
-    position = []
-    rotation = []
-    scale = []
-
-    def __init__(self, ar: FArchiveReader, scale):
-        self.name = ar.read_fstring()
-        self.parent_name = ar.read_fstring()
-        self.position = [pos * scale for pos in ar.read_float_vector(3)]
-        self.rotation = ar.read_float_vector(4)
-        self.scale = ar.read_float_vector(3)
-
-
-class UEAnim:
-    num_frames = 0
-    frames_per_second = 0
-    tracks = []
-    curves = []
-
-
-class Curve:
-    name = ""
-    keys = []
-
-    def __init__(self, ar: FArchiveReader):
-        self.name = ar.read_fstring()
-        self.keys = ar.read_bulk_array(lambda ar: FloatKey(ar))
-
-
-class Track:
-    name = ""
-    position_keys = []
-    rotation_keys = []
-    scale_keys = []
-
-    def __init__(self, ar: FArchiveReader, scale):
-        self.name = ar.read_fstring()
-        self.position_keys = ar.read_bulk_array(lambda ar: VectorKey(ar, scale))
-        self.rotation_keys = ar.read_bulk_array(lambda ar: QuatKey(ar))
-        self.scale_keys = ar.read_bulk_array(lambda ar: VectorKey(ar))
-
-
-class AnimKey:
-    frame = -1
-
-    def __init__(self, ar: FArchiveReader):
-        self.frame = ar.read_int()
-
-
-class VectorKey(AnimKey):
-    value = []
-
-    def __init__(self, ar: FArchiveReader, multiplier=1):
-        super().__init__(ar)
-        self.value = [float * multiplier for float in ar.read_float_vector(3)]
-
-    def get_vector(self):
-        return Vector(self.value)
-
-
-class QuatKey(AnimKey):
-    value = []
-
-    def __init__(self, ar: FArchiveReader):
-        super().__init__(ar)
-        self.value = ar.read_float_vector(4)
-
-    def get_quat(self):
-        return Quaternion((self.value[3], self.value[0], self.value[1], self.value[2]))
-
-
-class FloatKey(AnimKey):
-    value = 0.0
-
-    def __init__(self, ar: FArchiveReader):
-        super().__init__(ar)
-        self.value = ar.read_float()
-        
-class Actor:
-    mesh_hash = 0
-    name = ""
-    position = []
-    rotation = []
-    scale = []
-
-    def __init__(self, ar: FArchiveReader, scale):
-        self.mesh_hash = ar.read_int()
-        self.name = ar.read_fstring()
-        self.position = [pos * scale for pos in ar.read_float_vector(3)]
-        self.rotation = ar.read_float_vector(3)
-        self.scale = ar.read_float_vector(3)
@@ -1,13 +1,14 @@
-from .ue_format import UEFormatImport, UEModelOptions, Log
-import zstandard as zstd
-from . import ue_format
+from .ue_format import UEFormatImport, UEModelOptions, Log, MODEL_IDENTIFIER
 
-ue_format.zstd_decompresser = zstd.ZstdDecompressor()
 Log.NoLog = True
 
-def get_importer():
-    return UEFormatImport(UEModelOptions(False))
+def get_importer(sections=None, cache=None, profiler=None):
+    return UEFormatImport(UEModelOptions(False, sections=sections, cache=cache, profiler=profiler))
 
-def import_model(filepath):
-    importer = get_importer()
+def import_model(filepath, sections=None, cache=None, profiler=None):
+    importer = get_importer(sections, cache, profiler)
     return importer.import_file(filepath)
+
+def build_model(filepath, name, data, profiler=None):
+    # creates the mesh from an already decoded UEModel, see prefetch.MeshPrefetcher
+    return get_importer(profiler=profiler).import_file(filepath, (MODEL_IDENTIFIER, name, data))
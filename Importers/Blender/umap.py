@@ -13,13 +13,20 @@ from math import *
 from mathutils import Vector, Matrix, Euler, Quaternion
 import numpy as np
 from typing import Callable, Optional
+from contextlib import ExitStack
 from _bpy import ops
 
 from .utils import shade_smooth_fast
 from .remote_call_manager import process_child_comp
 from .texture import TextureMapping, Textures
 from .piana import *
-from .ueformat.wrapper import import_model
+from .ueformat.wrapper import import_model, build_model
+from .ueformat.ue_format import get_loop_vertex_indices, share_loop_vertex_indices, clear_loop_vertex_indices
+from .ueformat.decoder import STATIC_MESH_SECTIONS
+from .ueformat.cache import MeshCache, get_cache_dir
+from .ueformat.prefetch import MeshPrefetcher
+from .ueformat.profiling import ImportProfiler
+from .mapdata import CompTable, read_lazy_array
 
 try:
     from tqdm import tqdm
@@ -77,19 +84,113 @@ def trim_or_pad_string(input_string, desired_length, padding_char=" "):
 bar_format= "{l_bar}{bar}| [Elapsed: {elapsed} | Remaining: {remaining} | {rate_fmt}]"
 
 
-def sort_comps(comps):
-    # we move all the child comps to the end of the list
-    # so multi process import can import in the end
-    # doesn't slow down the main process
-    child_comps = []
-    new_comps = []
-    for comp in comps:
-        if comp[8] and len(comp[8]) > 0:
-            child_comps.append(comp)
-        else:
-            new_comps.append(comp)
+# ImportProfiler of the map import in progress, None when profiling is off
+active_profiler = None
+
+
+class KeyService:
+    # memoized string_hash_code and mesh reuse keys
+    # lives as long as the addon so sub levels and later imports never hash the same path or material set again
+
+    def __init__(self):
+        self.hashes = {} # string -> string_hash_code
+        self.keys = {} # (mesh path, material names, texture names, vertex color suffix) -> (key, td_suffix)
+
+    def get_hash(self, string: str) -> int:
+        code = self.hashes.get(string)
+        if code is None:
+            code = self.hashes[string] = string_hash_code(string)
+        return code
+
+    def add_hashes(self, strings):
+        # hashes the ones not seen yet in one vectorized batch
+        missing = [string for string in dict.fromkeys(strings) if string not in self.hashes]
+        if missing:
+            self.hashes.update(zip(missing, string_hash_codes(missing).tolist()))
+
+    def get_mesh_name_hash(self, path: str) -> str:
+        return os.path.basename(path) + f"_{abs(self.get_hash(path)):08x}"
+
+    def get_key(self, mesh_path: str, material_names: Optional[str], texture_names: Optional[str], vertex_color_suffix: Optional[int] = None):
+        # (key, td_suffix), material and texture names are None when the comp has none
+        cache_key = (mesh_path, material_names, texture_names, vertex_color_suffix)
+        cached = self.keys.get(cache_key)
+        if cached is None:
+            key = self.get_mesh_name_hash(mesh_path)
+            td_suffix = ""
+            if material_names is not None:
+                key += f"_{abs(self.get_hash(material_names)):08x}"
+            if texture_names is not None:
+                td_suffix = f"_{abs(self.get_hash(texture_names)):08x}"
+                if vertex_color_suffix:
+                    td_suffix = str(hash(td_suffix + f"_{vertex_color_suffix:08x}"))
+                key += td_suffix
+            cached = self.keys[cache_key] = (key, td_suffix)
+        return cached
+
+    def get_object_names(self, names):
+        # names longer than 50 (58 is blender limit) are cut and get their hash appended
+        long_names = [name for name in names if len(name) > 50]
+        if not long_names:
+            return names
+        self.add_hashes(long_names)
+        return [name[:40] + f"_{abs(self.hashes[name]):08x}" if len(name) > 50 else name for name in names]
+
+    def get_mesh_keys(self, table: CompTable):
+        # mesh paths and name hashes per mesh id, mesh keys and texture suffixes per row
+        # keys are built once per distinct mesh, material set, texture set and vertex color, not once per actor
+        mesh_paths = [path[1:] if path and path.startswith("/") else path for path in table.meshes]
+        material_names = [';'.join(mats.keys()) if mats and len(mats) > 0 else None for mats in table.material_sets]
+        texture_names = [';'.join([list(it.values())[0] if it else '' for it in texture_data]) if texture_data and len(texture_data) > 0 else None
+                         for texture_data in table.texture_sets]
+        self.add_hashes([string for string in mesh_paths + material_names + texture_names if string])
+        mesh_name_hashes = [self.get_mesh_name_hash(path) if path else None for path in mesh_paths]
+
+        ids = np.stack((table.mesh_ids, table.material_set_ids, table.texture_set_ids), axis=1)
+        combinations, inverse = np.unique(ids, axis=0, return_inverse=True)
+        combination_keys = [self.get_key(mesh_paths[mesh_id], material_names[mats_id], texture_names[texture_id]) if mesh_paths[mesh_id] else (None, "")
+                            for mesh_id, mats_id, texture_id in combinations.tolist()]
+        keys, td_suffixes = map(list, zip(*[combination_keys[index] for index in inverse.ravel().tolist()])) if len(table) else ([], [])
+
+        # vertex colours make the textured meshes of a row unique
+        for row in table.get_vertex_color_rows().tolist():
+            mesh_id, mats_id, texture_id = ids[row].tolist()
+            if texture_names[texture_id] is None or not mesh_paths[mesh_id]:
+                continue
+            vertex_color = table.get_vertex_color(row)
+            if isinstance(vertex_color, bytes): # keys stay the same as for the base64 text in the json
+                vertex_color_suffix = zlib.adler32(base64.b64encode(vertex_color))
+            else:
+                vertex_color_suffix = zlib.adler32(bytes(vertex_color, 'utf-8'))
+            keys[row], td_suffixes[row] = self.get_key(mesh_paths[mesh_id], material_names[mats_id], texture_names[texture_id], vertex_color_suffix)
+        return mesh_paths, mesh_name_hashes, keys, td_suffixes
+
+
+key_service = KeyService()
+
 
-    return new_comps + child_comps
+def get_object_transforms(table: CompTable):
+    # blender location and XYZ euler rotation of every row from unreal centimeters and degrees
+    # written as location, rotation and scale rather than matrix_world, blender would decompose a mirrored matrix
+    # into all negative scale axes and a turned rotation, which changes what the exporter writes out
+    locations = table.locations * (0.01, -0.01, 0.01)
+    rotations = np.radians(table.rotations[:, [2, 0, 1]] * (1, -1, -1))
+    return locations, rotations
+
+
+def get_prefetch_paths(table: CompTable, order, mesh_paths, mesh_name_hashes, light_indices, data_dir):
+    # .uemodel files import_umap will decode, in the order it reaches them
+    # meshes already in the file are copied instead of imported so they are left out
+    rows = order[~table.has_children[order] & (light_indices[order] >= 0)]
+    mesh_ids = table.mesh_ids[rows]
+    mesh_ids = mesh_ids[mesh_ids > 0]
+    _, first = np.unique(mesh_ids, return_index=True)
+
+    paths = []
+    for mesh_id in mesh_ids[np.sort(first)].tolist():
+        if mesh_paths[mesh_id] and bpy.data.meshes.get(mesh_name_hashes[mesh_id]) is None:
+            paths.append(os.path.join(data_dir, mesh_paths[mesh_id]) + ".uemodel")
+    return paths
 
 
 # ---------- END INPUTS, DO NOT MODIFY ANYTHING BELOW UNLESS YOU NEED TO ----------
@@ -98,6 +199,28 @@ def import_umap(processed_map_path: str,
                 reuse_meshes: bool, use_cube_as_fallback: bool, use_generic_shader: bool,
                 use_generic_shader_as_fallback: bool,
                 tex_shader, texture_mappings: TextureMapping, child_comp_import_callback: Optional[Callable] = None, autosave: bool = True) -> bpy.types.Object:
+    # what the import opens is registered on cleanup and released when it returns or fails, so a failed import
+    # doesn't leave the profiler active, prefetch threads running or the sidecar mapped for the next import
+    with ExitStack() as cleanup:
+        return import_map(cleanup, processed_map_path, into_collection, data_dir, reuse_maps, reuse_meshes, use_cube_as_fallback,
+                          use_generic_shader, use_generic_shader_as_fallback, tex_shader, texture_mappings,
+                          child_comp_import_callback, autosave)
+
+
+def write_profile_report(data_dir: str, map_name: str):
+    # ends the profiler of the map import that started it
+    global active_profiler
+    report = active_profiler.write_report(data_dir, map_name + ".ueformat_profile")
+    if report:
+        print("Import profile written to", report[1])
+    active_profiler = None
+
+
+def import_map(cleanup: ExitStack, processed_map_path: str,
+               into_collection: bpy.types.Collection, data_dir: str, reuse_maps: bool,
+               reuse_meshes: bool, use_cube_as_fallback: bool, use_generic_shader: bool,
+               use_generic_shader_as_fallback: bool,
+               tex_shader, texture_mappings: TextureMapping, child_comp_import_callback: Optional[Callable] = None, autosave: bool = True) -> bpy.types.Object:
 
     child_comp_import_callback = child_comp_import_callback or import_umap
 
@@ -125,49 +248,69 @@ def import_umap(processed_map_path: str,
     map_scene.collection.children.link(map_collection)
     map_layer_collection = map_scene.view_layers[0].layer_collection.children[map_collection.name]
 
-    with open(os.path.join(data_dir, "jsons" + processed_map_path + ".processed.json")) as file:
-        comps = json.loads(file.read())
+    # the whole map as columns, from the .processed.bin sidecar instead of the json when it has been converted
+    # the json is streamed into it so it is never fully decoded
+    table = cleanup.enter_context(CompTable.from_path(os.path.join(data_dir, "jsons" + processed_map_path + ".processed.json")))
+    cleanup.callback(clear_loop_vertex_indices)
 
-    comps = sort_comps(comps)
+    mesh_cache = None
+    preferences = bpy.context.preferences.addons[__package__].preferences
+    if preferences.bUseMeshCache:
+        mesh_cache = MeshCache(get_cache_dir(data_dir), preferences.mesh_cache_size * 1024 ** 2)
 
     blights_exist = False
     if os.path.exists(os.path.join(data_dir, "jsons" + processed_map_path + ".lights.processed.json")):
-        with open(os.path.join(data_dir, "jsons" + processed_map_path + ".lights.processed.json")) as file:
-            lights = json.loads(file.read())
+        lights = read_lazy_array(os.path.join(data_dir, "jsons" + processed_map_path + ".lights.processed.json"))
         blights_exist = True
 
-    pbar = tqdm(comps, bar_format=bar_format, leave=False, unit=" actor")
-    for comp_i, comp in enumerate(pbar):
-        # guid = comp[0]
-        name = comp[1]
-        mesh_path = comp[2]
-        mats = comp[3]
-        texture_data = comp[4]
-        location = comp[5] or [0, 0, 0]
-        rotation = comp[6] or [0, 0, 0]
-        scale = comp[7] or [1, 1, 1]
-        child_comps = comp[8]
-        light_index = comp[9] if blights_exist else 0
-        instanceData = comp[10] if len(comp) > 10 else []    # list of Transforms
-        vertex_color: bytes = comp[11] if len(comp) > 11 else None # serialized as base64 string -> bytes (0-255)BGRA
+    # sub levels imported in this process add to the profiler of the map that started the import
+    global active_profiler
+    owns_profiler = active_profiler is None
+    if owns_profiler:
+        profiler = ImportProfiler(preferences.profile_every_nth, int(preferences.profile_min_size * 1024 ** 2))
+        active_profiler = profiler if profiler else None
+        if active_profiler:
+            cleanup.callback(write_profile_report, data_dir, map_name)
+
+    # whole map passes before any object is created, child comps go last so multi process import can import them in the end
+    order = table.get_order()
+    light_indices = table.light_indices if blights_exist else np.zeros(len(table), dtype=np.int32)
+    mesh_paths, mesh_name_hashes, keys, td_suffixes = key_service.get_mesh_keys(table)
+    names = key_service.get_object_names(table.names)
+    locations, rotations = get_object_transforms(table)
+
+    # meshes decoded on worker threads ahead of the actor that builds them
+    prefetcher = None
+    if preferences.mesh_prefetch_threads > 0:
+        prefetcher = cleanup.enter_context(MeshPrefetcher(get_prefetch_paths(table, order, mesh_paths, mesh_name_hashes, light_indices, data_dir),
+                                                          cache=mesh_cache, profiler=active_profiler, workers=preferences.mesh_prefetch_threads))
+
+    pbar = tqdm(order.tolist(), bar_format=bar_format, leave=False, unit=" actor")
+    for comp_i, row in enumerate(pbar):
+        name = names[row]
+        mesh_path = mesh_paths[table.mesh_ids[row]]
+        mats = table.material_sets[table.material_set_ids[row]]
+        location = locations[row]
+        rotation = rotations[row]
+        scale = table.scales[row]
+        child_comps = table.child_comps.get(row)
+        light_index = light_indices[row]
+        instanceData = table.get_instances(row)    # list of Transforms
+        vertex_color: bytes = table.get_vertex_color(row) # serialized as base64 string -> bytes (0-255)BGRA, already bytes in the sidecar
 
         # if not vertex_color and len(child_comps or []) == 0:
         #     assert vertex_color is None, "Vertex color should be None if there are child comps"
         #     assert len(child_comps or []) == 0, "Child comps should not be empty if there are no vertex color"
         #     continue
 
-        # if name is bigger than 50 (58 is blender limit) than hash it and use it as name
-        if len(name) > 50:
-            name = name[:40] + f"_{abs(string_hash_code(name)):08x}"
-
         # print("\nActor %d of %d: %s" % (comp_i + 1, len(comps), name))
-        pbar.set_description(f"Actor {comp_i + 1} of {len(comps)}: {trim_or_pad_string(name, 25)}")
+        pbar.set_description(f"Actor {comp_i + 1} of {len(table)}: {trim_or_pad_string(name, 25)}")
 
         def apply_ob_props(ob: bpy.types.Object, new_name: str = name) -> bpy.types.Object:
             ob.name = new_name
-            ob.location = [location[0] * 0.01, location[1] * -0.01, location[2] * 0.01]
+            ob.location = location
             ob.rotation_mode = 'XYZ'
-            ob.rotation_euler = [radians(rotation[2]), radians(-rotation[0]), radians(-rotation[1])]
+            ob.rotation_euler = rotation
             ob.scale = scale
             return ob
 
@@ -218,24 +361,9 @@ def import_umap(processed_map_path: str,
             new_object()
             continue
 
-        if mesh_path.startswith("/"):
-            mesh_path = mesh_path[1:]
-
-        mesh_name_hash = os.path.basename(mesh_path) + f"_{abs(string_hash_code(mesh_path)):08x}"
-        key = mesh_name_hash
-        td_suffix = ""
-
-        vertex_color_suffix = zlib.adler32(bytes(vertex_color, 'utf-8')) if vertex_color else None
-
-        if mats and len(mats) > 0:
-            key += f"_{abs(string_hash_code(';'.join(mats.keys()))):08x}"
-        if texture_data and len(texture_data) > 0:
-            td_suffix = f"_{abs(string_hash_code(';'.join([list(it.values())[0] if it else '' for it in texture_data]))):08x}"
-
-            if vertex_color_suffix:
-                td_suffix = str(hash(td_suffix + f"_{vertex_color_suffix:08x}"))
-
-            key += td_suffix
+        mesh_name_hash = mesh_name_hashes[table.mesh_ids[row]]
+        key = keys[row]
+        td_suffix = td_suffixes[row]
 
         existing_mesh = bpy.data.meshes.get(key) if reuse_meshes else None
 
@@ -262,17 +390,25 @@ def import_umap(processed_map_path: str,
             imported = None
             if existing_mesh:
                 data_copy = existing_mesh.copy()
+                share_loop_vertex_indices(existing_mesh, data_copy)
                 imported = bpy.data.objects.new(mesh_name_hash, data_copy)
             else:
-                imported = import_model(full_mesh_path)
+                decoded = prefetcher.take(full_mesh_path) if prefetcher else None
+                if decoded:
+                    imported = build_model(full_mesh_path, *decoded, profiler=active_profiler)
+                else:
+                    # props end up static in the level, don't decode skeletons, weights and morphs
+                    imported = import_model(full_mesh_path, STATIC_MESH_SECTIONS, mesh_cache, active_profiler)
                 imported.name = mesh_name_hash
 
                 imported.data.name = mesh_name_hash
+                original_data = imported.data
                 imported.data = imported.data.copy() # preserve the original mesh data ig (theoretically this should work)
+                share_loop_vertex_indices(original_data, imported.data)
 
             if imported:
                 if vertex_color:
-                    decoded = base64.b64decode(vertex_color)
+                    decoded = vertex_color if isinstance(vertex_color, bytes) else base64.b64decode(vertex_color)
                     # colors = struct.unpack("c"*len(decoded), decoded)
 
                     np_colors = np.frombuffer(decoded, dtype=np.uint8).astype(np.uint8)
@@ -290,7 +426,7 @@ def import_umap(processed_map_path: str,
                     if len(imported.data.vertex_colors) == 0:
                         imported.data.color_attributes.new(domain='CORNER', type='BYTE_COLOR', name="OverrideColor")
 
-                    vertices = [vertex for polygon in imported.data.polygons for vertex in polygon.vertices]
+                    vertices = get_loop_vertex_indices(imported.data)
 
                     remapped = np_colors[vertices]
                     # unreal doesnt support multiple vertex color layers so this will always be 0 index
@@ -690,6 +826,23 @@ def string_hash_code(s: str) -> int:
         h = (31 * h + ord(c)) & 0xFFFFFFFF
     return ((h + 0x80000000) & 0xFFFFFFFF) - 0x80000000
 
+
+def string_hash_codes(strings) -> np.ndarray:
+    # string_hash_code of many strings at once, sum of c * 31^(characters after c)
+    # uint64 math wraps modulo 2^64 which keeps the low 32 bits exact
+    lengths = np.fromiter(map(len, strings), dtype=np.int64, count=len(strings))
+    codes = np.frombuffer("".join(strings).encode("utf-32-le", "surrogatepass"), dtype="<u4").astype(np.uint64)
+    ends = np.cumsum(lengths)
+    powers = np.cumprod(np.full(max(lengths.max(initial=0), 1), 31, dtype=np.uint64))
+    powers = np.concatenate((np.ones(1, dtype=np.uint64), powers[:-1]))
+    terms = codes * powers[np.repeat(ends, lengths) - 1 - np.arange(len(codes))]
+
+    sums = np.zeros(len(strings), dtype=np.uint64)
+    not_empty = lengths > 0
+    if not_empty.any():
+        sums[not_empty] = np.add.reduceat(terms, (ends - lengths)[not_empty])
+    return (sums & 0xFFFFFFFF).astype(np.uint32).view(np.int32)
+
 if __name__ == "__main__":
     data_dir = r"C:\Users\satri\Documents\AppProjects\BlenderUmap\run"
 
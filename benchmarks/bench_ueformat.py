@@ -0,0 +1,154 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Importers", "Blender", "ueformat"))
+
+import decoder # bpy-free, runs without Blender
+from decoder import FArchiveReader, MODEL_IDENTIFIER, ANIM_IDENTIFIER, read_header, read_body, read_section_index, read_uemodel, read_ueanim, read_data
+from ueformat_writer import build_uemodel, build_ueanim
+
+# decode throughput and peak memory of the UEFormat decoder on synthetic files
+#   python benchmarks/bench_ueformat.py --save baseline.json
+#   python benchmarks/bench_ueformat.py --baseline baseline.json
+
+CASES = {
+    "static_small": lambda compression, scale: build_uemodel(vertices=int(2000 * scale), compression=compression),
+    "static_large": lambda compression, scale: build_uemodel(vertices=int(250000 * scale), uv_layers=2, color_layers=1, materials=4, compression=compression),
+    "skeletal": lambda compression, scale: build_uemodel(vertices=int(60000 * scale), uv_layers=1, color_layers=0, materials=2, bones=200,
+                                                         weights_per_vertex=4, morphs=20, sockets=10, compression=compression),
+    "anim": lambda compression, scale: build_ueanim(tracks=150, frames=int(600 * scale), curves=50, compression=compression),
+}
+COMPRESSIONS = {"none": None, "gzip": "GZIP", "zstd": "ZSTD"}
+
+
+def best_time(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def peak_memory(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(function, repeat, size, vertices=0):
+    seconds = best_time(function, repeat)
+    result = {"seconds": seconds, "mb_per_s": size / seconds / 1024 ** 2 if seconds > 0 else 0, "peak_mb": peak_memory(function) / 1024 ** 2}
+    if vertices:
+        result["vertices_per_s"] = vertices / seconds if seconds > 0 else 0
+    return result
+
+
+def run_case(data: bytes, repeat: int):
+    # total decode, decompression alone, then every model or animation section decoded on its own from the decompressed body
+    results = {"total": None}
+    with FArchiveReader(data) as ar:
+        identifier, file_version, _ = read_header(ar)
+        body_offset = ar.tell()
+        body = read_body(ar)
+        body_bytes = body.data[body.tell():].tobytes() # uncompressed bodies are the rest of the same archive
+
+    sections = {}
+    if identifier == MODEL_IDENTIFIER:
+        sections = read_section_index(FArchiveReader(body_bytes))
+    elif identifier == ANIM_IDENTIFIER:
+        index = FArchiveReader(body_bytes)
+        index.skip(8) # frame count and frame rate come before the sections
+        sections = read_section_index(index)
+    vertices = sections.get("VERTICES", (0,))[0]
+
+    results["total"] = measure(lambda: read_data(data), repeat, len(data), vertices)
+
+    def decompress():
+        with FArchiveReader(data) as ar:
+            ar.seek(body_offset)
+            read_body(ar)
+    if data[body_offset] != 0:
+        results["decompress"] = measure(decompress, repeat, len(body_bytes))
+
+    for name, (array_size, _, byte_size) in sections.items():
+        section_vertices = array_size if name in ("VERTICES", "NORMALS") else 0
+        if identifier == MODEL_IDENTIFIER:
+            decode = lambda: read_uemodel(FArchiveReader(body_bytes), file_version, 0.01, {name})
+        else:
+            decode = lambda: read_ueanim(FArchiveReader(body_bytes), 0.01, {name})
+        results[name] = measure(decode, repeat, byte_size, section_vertices)
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    # ratio of current time to the baseline time, above 1 + threshold counts as a regression
+    regressions = []
+    for case, metrics in results.items():
+        for metric, result in metrics.items():
+            previous = baseline.get(case, {}).get(metric)
+            if previous is None or previous["seconds"] <= 0:
+                continue
+            ratio = result["seconds"] / previous["seconds"]
+            result["vs_baseline"] = ratio
+            if ratio > 1 + threshold:
+                regressions.append((case, metric, ratio))
+    return regressions
+
+
+def print_results(results):
+    print(f"{'case':<24}{'section':<14}{'ms':>10}{'MB/s':>10}{'Mverts/s':>10}{'peak MB':>10}{'vs base':>9}")
+    for case, metrics in results.items():
+        for metric, result in metrics.items():
+            vertices = result.get("vertices_per_s")
+            ratio = result.get("vs_baseline")
+            print(f"{case:<24}{metric:<14}{result['seconds'] * 1000:>10.3f}{result['mb_per_s']:>10.1f}"
+                  f"{(f'{vertices / 1e6:.2f}' if vertices else '-'):>10}{result['peak_mb']:>10.2f}"
+                  f"{(f'{ratio:.2f}x' if ratio else '-'):>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the UEFormat decoder on synthetic files, no Blender needed")
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES))
+    parser.add_argument("--compression", nargs="+", choices=list(COMPRESSIONS), default=list(COMPRESSIONS))
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies vertex and frame counts")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per measurement, the fastest is kept")
+    parser.add_argument("--save", help="write the results as a baseline json")
+    parser.add_argument("--baseline", help="baseline json to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    decoder.Log.NoLog = True
+    results = {}
+    for case in args.cases:
+        for compression in args.compression:
+            data = CASES[case](COMPRESSIONS[compression], args.scale)
+            results[f"{case}/{compression}"] = run_case(data, args.repeat)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file)["results"], args.threshold)
+
+    print_results(results)
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "scale": args.scale, "results": results}, file, indent=2)
+
+    for case, metric, ratio in regressions:
+        print(f"REGRESSION: {case} {metric} is {ratio:.2f}x the baseline time")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+import gzip
+import struct
+import numpy as np
+import zstandard as zstd
+
+# writes synthetic .uemodel/.ueanim files laid out like the ones BlenderUmap exports, for benchmarking the decoder
+
+MAGIC = b"UEFORMAT"
+FILE_VERSION = 2 # EUEFormatVersion.AddMultipleVertexColors
+
+
+def fstring(value: str):
+    encoded = value.encode() + b"\x00"
+    return struct.pack("<i", len(encoded)) + encoded
+
+
+def section(name: str, array_size: int, payload: bytes):
+    return fstring(name) + struct.pack("<ii", array_size, len(payload)) + payload
+
+
+def write_file(identifier: str, name: str, body: bytes, compression=None):
+    header = MAGIC + fstring(identifier) + bytes((FILE_VERSION,)) + fstring(name)
+    if compression is None:
+        return header + b"\x00" + body
+
+    if compression == "GZIP":
+        compressed = gzip.compress(body, compresslevel=6)
+    elif compression == "ZSTD":
+        compressed = zstd.ZstdCompressor(level=3).compress(body)
+    else:
+        raise ValueError(f"Unknown compression {compression}")
+    return header + b"\x01" + fstring(compression) + struct.pack("<ii", len(body), len(compressed)) + compressed
+
+
+def grid_mesh(vertex_count: int, rng):
+    # a strip of quads, two triangles each, so any vertex count gives a valid index buffer
+    columns = max(2, int(np.sqrt(vertex_count)))
+    rows = max(2, vertex_count // columns)
+    x, y = np.meshgrid(np.arange(columns, dtype=np.float32), np.arange(rows, dtype=np.float32))
+    vertices = np.stack((x.ravel(), y.ravel(), rng.random(rows * columns, dtype=np.float32)), axis=1) * 100
+
+    corner = (np.arange(rows - 1)[:, None] * columns + np.arange(columns - 1)[None, :]).ravel()
+    indices = np.stack((corner, corner + columns, corner + 1, corner + 1, corner + columns, corner + columns + 1), axis=1)
+    return vertices, indices.astype(np.int32).ravel()
+
+
+def build_uemodel(vertices=10000, uv_layers=1, color_layers=1, materials=1, bones=0, weights_per_vertex=0,
+                  morphs=0, morph_fraction=0.1, sockets=0, compression="ZSTD", seed=0):
+    rng = np.random.default_rng(seed)
+    positions, indices = grid_mesh(vertices, rng)
+    vertex_count = len(positions)
+    body = bytearray()
+
+    body += section("VERTICES", vertex_count, positions.astype("<f4").tobytes())
+    body += section("INDICES", len(indices), indices.astype("<i4").tobytes())
+
+    normals = rng.standard_normal((vertex_count, 4), dtype=np.float32)
+    normals[:, 0] = 1 # binormal sign
+    body += section("NORMALS", vertex_count, normals.astype("<f4").tobytes())
+
+    if color_layers > 0:
+        payload = bytearray()
+        for layer in range(color_layers):
+            payload += fstring(f"COL{layer}") + struct.pack("<i", vertex_count)
+            payload += rng.integers(0, 256, vertex_count * 4, dtype=np.uint8).tobytes()
+        body += section("VERTEXCOLORS", color_layers, bytes(payload))
+
+    if uv_layers > 0:
+        payload = bytearray()
+        for layer in range(uv_layers):
+            payload += struct.pack("<i", vertex_count) + rng.random((vertex_count, 2), dtype=np.float32).astype("<f4").tobytes()
+        body += section("TEXCOORDS", uv_layers, bytes(payload))
+
+    if materials > 0:
+        face_count = len(indices) // 3
+        bounds = np.linspace(0, face_count, materials + 1).astype(int)
+        payload = bytearray()
+        for index in range(materials):
+            payload += fstring(f"/Game/Materials/M_Synthetic_{index}") + struct.pack("<ii", bounds[index] * 3, bounds[index + 1] - bounds[index])
+        body += section("MATERIALS", materials, bytes(payload))
+
+    if bones > 0 and weights_per_vertex > 0:
+        weights = np.empty(vertex_count * weights_per_vertex, dtype=[("bone_index", "<i2"), ("vertex_index", "<i4"), ("weight", "<f4")])
+        weights["vertex_index"] = np.repeat(np.arange(vertex_count, dtype=np.int32), weights_per_vertex)
+        weights["bone_index"] = rng.integers(0, bones, len(weights), dtype=np.int16)
+        weights["weight"] = 1 / weights_per_vertex
+        body += section("WEIGHTS", len(weights), weights.tobytes())
+
+    if morphs > 0:
+        delta_count = max(1, int(vertex_count * morph_fraction))
+        payload = bytearray()
+        for index in range(morphs):
+            deltas = np.empty(delta_count, dtype=[("position", "<f4", (3,)), ("normals", "<f4", (3,)), ("vertex_index", "<i4")])
+            deltas["position"] = rng.standard_normal((delta_count, 3), dtype=np.float32)
+            deltas["normals"] = 0
+            deltas["vertex_index"] = np.sort(rng.choice(vertex_count, delta_count, replace=False))
+            payload += fstring(f"Morph_{index}") + struct.pack("<i", delta_count) + deltas.tobytes()
+        body += section("MORPHTARGETS", morphs, bytes(payload))
+
+    if bones > 0:
+        payload = bytearray()
+        for index in range(bones):
+            parent = -1 if index == 0 else int(rng.integers(0, index))
+            payload += fstring(f"bone_{index:04d}") + struct.pack("<i7f", parent, 0, 0, 10, 0, 0, 0, 1)
+        body += section("BONES", bones, bytes(payload))
+
+    if sockets > 0 and bones > 0:
+        payload = bytearray()
+        for index in range(sockets):
+            payload += fstring(f"socket_{index}") + fstring(f"bone_{index % bones:04d}") + struct.pack("<10f", 0, 5, 0, 0, 0, 0, 1, 1, 1, 1)
+        body += section("SOCKETS", sockets, bytes(payload))
+
+    return write_file("UEMODEL", "SM_Synthetic", bytes(body), compression)
+
+
+def vector_keys(count: int, width: int, rng, frames):
+    keys = np.empty(count, dtype=[("frame", "<i4"), ("value", "<f4", (width,))])
+    keys["frame"] = frames[:count]
+    keys["value"] = rng.standard_normal((count, width), dtype=np.float32)
+    return struct.pack("<i", count) + keys.tobytes()
+
+
+def build_ueanim(tracks=100, frames=300, curves=0, compression="ZSTD", seed=0):
+    rng = np.random.default_rng(seed)
+    frame_numbers = np.arange(frames, dtype=np.int32)
+    body = bytearray(struct.pack("<if", frames, 30.0))
+
+    payload = bytearray()
+    for index in range(tracks):
+        payload += fstring(f"bone_{index:04d}")
+        payload += vector_keys(frames, 3, rng, frame_numbers)
+        payload += vector_keys(frames, 4, rng, frame_numbers)
+        payload += vector_keys(frames, 3, rng, frame_numbers)
+    body += section("TRACKS", tracks, bytes(payload))
+
+    if curves > 0:
+        payload = bytearray()
+        for index in range(curves):
+            keys = np.empty(frames, dtype=[("frame", "<i4"), ("value", "<f4")])
+            keys["frame"] = frame_numbers
+            keys["value"] = rng.random(frames, dtype=np.float32)
+            payload += fstring(f"Curve_{index}") + struct.pack("<i", frames) + keys.tobytes()
+        body += section("CURVES", curves, bytes(payload))
+
+    return write_file("UEANIM", "A_Synthetic", bytes(body), compression)